@@ -0,0 +1,151 @@
+import subprocess
+import argparse
+import tempfile
+import asyncio
+import random
+import socket
+import shlex
+import time
+import sys
+import os
+
+from client import AsyncConnection, add_command, get_command
+
+
+class LatencyStats:
+    '''Собирает задержки команд и считает по ним пропускную способность и перцентили.'''
+    PERCENTILES = (0.5, 0.99, 0.999)
+
+    def __init__(self):
+        self._latencies = {} # Задержки в секундах по имени команды.
+
+
+    def record(self, command: str, latency: float) -> None:
+        self._latencies.setdefault(command, []).append(latency)
+
+
+    def count(self, command: str) -> int:
+        return len(self._latencies.get(command, ()))
+
+
+    def percentile(self, command: str, percentile: float) -> float:
+        latencies = sorted(self._latencies[command])
+        return latencies[min(len(latencies) - 1, int(percentile * len(latencies)))]
+
+
+    def report(self, duration: float) -> str:
+        lines = [f'{"command":<8}{"count":>10}{"ops/s":>12}' + ''.join(f'{f"p{percentile * 100:g} ms":>12}' for percentile in self.PERCENTILES)]
+        for command in sorted(self._latencies):
+            percentiles = ''.join(f'{self.percentile(command, percentile) * 1000:>12.3f}' for percentile in self.PERCENTILES)
+            lines.append(f'{command:<8}{self.count(command):>10}{self.count(command) / duration:>12.1f}{percentiles}')
+        return '\n'.join(lines)
+
+
+class Benchmark:
+    '''Нагружает запущенный сервер производителями (ADD) и потребителями (GET и ACK) на заданное время.
+       Часть полученных заданий потребители не подтверждают, эти задания возвращаются в очередь по таймауту.'''
+    def __init__(self, host: str, port: int, producers: int, consumers: int, queues: int, payload_size: int,
+                 ack_ratio: float, duration: float, pipeline: int):
+        self._host = host
+        self._port = port
+        self._producers = producers
+        self._consumers = consumers
+        self._queues = [f'bench_{queue}'.encode('utf-8') for queue in range(queues)]
+        self._payload = b'x' * payload_size
+        self._ack_ratio = ack_ratio # Доля полученных заданий, выполнение которых подтверждается.
+        self._duration = duration
+        self._pipeline = pipeline # Сколько команд отправляется одним пакетом.
+        self.stats = LatencyStats()
+        self.empty_rounds = 0 # Сколько раз потребитель не получил ни одного задания.
+
+
+    async def _timing(self, connection: AsyncConnection, name: str, commands: list[bytes]) -> list[bytes]:
+        '''Выполняет пакет команд, каждой команде пакета засчитывается время всего пакета.'''
+        start = time.perf_counter()
+        responses = await connection.pipeline(commands)
+        latency = time.perf_counter() - start
+        for _ in commands:
+            self.stats.record(name, latency)
+        return responses
+
+
+    async def _producing(self, deadline: float) -> None:
+        connection = await AsyncConnection.open(self._host, self._port)
+        while time.perf_counter() < deadline:
+            commands = [add_command(random.choice(self._queues), self._payload) for _ in range(self._pipeline)]
+            await self._timing(connection, 'ADD', commands)
+        connection.close()
+
+
+    async def _consuming(self, deadline: float) -> None:
+        connection = await AsyncConnection.open(self._host, self._port)
+        while time.perf_counter() < deadline:
+            queues = [random.choice(self._queues) for _ in range(self._pipeline)]
+            responses = await self._timing(connection, 'GET', [get_command(queue) for queue in queues])
+            acks = [b' '.join([b'ACK', queue, response.split(b' ', 1)[0]]) for queue, response in zip(queues, responses)
+                    if response != b'NONE' and random.random() < self._ack_ratio]
+            if acks:
+                await self._timing(connection, 'ACK', acks)
+            if all(response == b'NONE' for response in responses):
+                self.empty_rounds += 1
+                await asyncio.sleep(0.001)
+        connection.close()
+
+
+    async def _running(self) -> None:
+        deadline = time.perf_counter() + self._duration
+        await asyncio.gather(*[self._producing(deadline) for _ in range(self._producers)],
+                             *[self._consuming(deadline) for _ in range(self._consumers)])
+
+
+    def run(self) -> LatencyStats:
+        asyncio.run(self._running())
+        return self.stats
+
+
+def start_server(port: int, path: str, timeout: int, server_args: list[str]) -> subprocess.Popen:
+    '''Запускает сервер рядом лежащего server.py в асинхронном режиме и ждет, пока он начнет принимать соединения.'''
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+    server = subprocess.Popen([sys.executable, server_path, '-a', '-p', str(port), '-c', path, '-t', str(timeout), *server_args])
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('Server did not start')
+
+
+def parse_args(args: list[str]=None):
+    parser = argparse.ArgumentParser(description='Load generator for the task queue server')
+    parser.add_argument('-p', action="store", dest="port", type=int, default=5555, help='Server port')
+    parser.add_argument('-P', action="store", dest="producers", type=int, default=4, help='Producer connections')
+    parser.add_argument('-C', action="store", dest="consumers", type=int, default=4, help='Consumer connections')
+    parser.add_argument('-q', action="store", dest="queues", type=int, default=1, help='Number of queues')
+    parser.add_argument('-b', action="store", dest="payload_size", type=int, default=100, help='Payload size in bytes')
+    parser.add_argument('-r', action="store", dest="ack_ratio", type=float, default=1.0,
+                        help='Share of received tasks that are acknowledged, the rest expire')
+    parser.add_argument('-d', action="store", dest="duration", type=float, default=10, help='Benchmark duration in seconds')
+    parser.add_argument('-l', action="store", dest="pipeline", type=int, default=1, help='Commands sent per round trip')
+    parser.add_argument('-t', action="store", dest="timeout", type=int, default=5, help='Server task timeout in seconds')
+    parser.add_argument('-s', action="store", dest="server_args", type=shlex.split, default=[],
+                        help='Extra server arguments, for example "-n 4 -m"')
+    parser.add_argument('-e', action="store_true", dest="external", help='Use an already running server')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as path:
+        server = None if args.external else start_server(args.port, path + os.sep, args.timeout, args.server_args)
+        try:
+            benchmark = Benchmark('127.0.0.1', args.port, args.producers, args.consumers, args.queues, args.payload_size,
+                                  args.ack_ratio, args.duration, args.pipeline)
+            benchmark.run()
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+    print(benchmark.stats.report(args.duration))
+    print(f'Empty GET rounds: {benchmark.empty_rounds}')
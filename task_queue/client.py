@@ -0,0 +1,339 @@
+from collections.abc import Iterable
+from contextlib import contextmanager, asynccontextmanager
+import threading
+import asyncio
+import socket
+import queue
+
+
+class TaskQueueError(Exception):
+    '''Сервер не выполнил команду: ответил ERROR или STANDBY (резервный сервер).'''
+
+
+def checked(response: bytes) -> bytes:
+    '''Возвращает ответ сервера, на ответы ERROR и STANDBY выбрасывает TaskQueueError.'''
+    if response in (b'ERROR', b'STANDBY'):
+        raise TaskQueueError(response.decode('utf-8'))
+    return response
+
+
+def encode(value: bytes | str | int) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+def add_options(priority: int=None, delay: float=None) -> list[bytes]:
+    '''Возвращает необязательные приоритет и задержку выдачи, которые записываются после содержимого заданий.'''
+    if delay:
+        return [encode(priority or 0), encode(delay)]
+    if priority is not None:
+        return [encode(priority)]
+    return []
+
+
+def add_command(queue_name: bytes | str, data: bytes, priority: int=None, delay: float=None) -> bytes:
+    return b' '.join([b'ADD', encode(queue_name), encode(len(data)), data, *add_options(priority, delay)])
+
+
+def add_many_command(queue_name: bytes | str, datas: list[bytes], priority: int=None, delay: float=None) -> bytes:
+    payloads = [part for data in datas for part in (encode(len(data)), data)]
+    return b' '.join([b'MADD', encode(queue_name), encode(len(datas)), *payloads, *add_options(priority, delay)])
+
+
+def get_command(queue_name: bytes | str, wait: float=None) -> bytes:
+    command = [b'GET', encode(queue_name)]
+    if wait:
+        command.append(encode(wait))
+    return b' '.join(command)
+
+
+def touch_command(queue_name: bytes | str, id: bytes | int, timeout: float=None) -> bytes:
+    command = [b'TOUCH', encode(queue_name), encode(id)]
+    if timeout:
+        command.append(encode(timeout))
+    return b' '.join(command)
+
+
+def parse_task(response: bytes) -> tuple[bytes, bytes] | None:
+    '''Разбирает ответ GET на идентификатор и содержимое задания, None если заданий нет.'''
+    if response == b'NONE':
+        return None
+    id, _, data = response.split(b' ', 2)
+    return id, data
+
+
+def parse_tasks(response: bytes) -> list[tuple[bytes, bytes]]:
+    '''Разбирает ответ MGET: число заданий и для каждого идентификатор, длину и содержимое.'''
+    if response == b'NONE':
+        return []
+    position = response.index(b' ') + 1
+    tasks = []
+    for _ in range(int(response[:position - 1])):
+        id_end = response.index(b' ', position)
+        length_end = response.index(b' ', id_end + 1)
+        data_end = length_end + 1 + int(response[id_end + 1:length_end])
+        tasks.append((response[position:id_end], response[length_end + 1:data_end]))
+        position = data_end + 1
+    return tasks
+
+
+class Connection:
+    '''Соединение с сервером в асинхронном режиме. Сразу включает ответы с префиксом длины (FRAMED),
+       поэтому ответы читаются целиком, даже если содержимое заданий содержит переводы строк.'''
+    def __init__(self, host: str, port: int, timeout: float=None):
+        self._socket = socket.create_connection((host, port), timeout)
+        self._responses = self._socket.makefile('rb')
+        self.pipeline([b'FRAMED'])
+
+
+    def pipeline(self, commands: list[bytes]) -> list[bytes]:
+        '''Отправляет все команды одним пакетом и только потом читает ответы.'''
+        self._socket.sendall(b''.join(command + b'\n' for command in commands))
+        return [self._read_response() for _ in commands]
+
+
+    def _read_response(self) -> bytes:
+        length = b''
+        while (char := self._responses.read(1)) != b' ':
+            if not char:
+                raise ConnectionError('Server closed the connection')
+            length += char
+        response = self._responses.read(int(length) + 1)
+        if len(response) < int(length) + 1:
+            raise ConnectionError('Server closed the connection')
+        return response[:-1]
+
+
+    def close(self) -> None:
+        self._responses.close()
+        self._socket.close()
+
+
+class TaskQueueClient:
+    '''Клиент сервера очередей с пулом соединений. Потокобезопасен: каждый вызов берет соединение
+       из пула на время своих команд, несколько команд одного вызова отправляются без ожидания ответов.'''
+    def __init__(self, host: str='127.0.0.1', port: int=5555, pool_size: int=4, timeout: float=None):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._pool = queue.LifoQueue() # Свободные открытые соединения.
+        self._free = threading.Semaphore(pool_size) # Сколько еще соединений можно открыть.
+
+
+    @contextmanager
+    def _connection(self):
+        try:
+            connection = self._pool.get_nowait()
+        except queue.Empty:
+            connection = self._opening()
+
+        # Соединение, прерванное чем угодно, включая отмену, закрывается: в нем могут остаться непрочитанные ответы.
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            self._free.release()
+            raise
+        self._pool.put(connection)
+
+
+    def _opening(self) -> Connection:
+        '''Открывает новое соединение, если пул еще не заполнен, иначе ждет освободившееся.
+           Ожидание периодически прерывается, чтобы заметить место, освобожденное разорванным соединением.'''
+        while not self._free.acquire(blocking=False):
+            try:
+                return self._pool.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        try:
+            return Connection(self._host, self._port, self._timeout)
+        except BaseException:
+            self._free.release()
+            raise
+
+
+    def pipeline(self, commands: Iterable[bytes]) -> list[bytes]:
+        with self._connection() as connection:
+            return connection.pipeline(list(commands))
+
+
+    def add(self, queue_name: bytes | str, data: bytes, priority: int=None, delay: float=None) -> bytes:
+        return checked(self.pipeline([add_command(queue_name, data, priority, delay)])[0])
+
+
+    def add_many(self, queue_name: bytes | str, datas: list[bytes], priority: int=None, delay: float=None) -> list[bytes]:
+        if not datas:
+            return []
+        return checked(self.pipeline([add_many_command(queue_name, datas, priority, delay)])[0]).split(b' ')
+
+
+    def get(self, queue_name: bytes | str, wait: float=None) -> tuple[bytes, bytes] | None:
+        return parse_task(checked(self.pipeline([get_command(queue_name, wait)])[0]))
+
+
+    def get_many(self, queue_name: bytes | str, count: int) -> list[tuple[bytes, bytes]]:
+        return parse_tasks(checked(self.pipeline([b' '.join([b'MGET', encode(queue_name), encode(count)])])[0]))
+
+
+    def ack(self, queue_name: bytes | str, id: bytes | int) -> bool:
+        return self.ack_many(queue_name, [id])[0]
+
+
+    def ack_many(self, queue_name: bytes | str, ids: Iterable[bytes | int]) -> list[bool]:
+        commands = [b' '.join([b'ACK', encode(queue_name), encode(id)]) for id in ids]
+        return [checked(response) == b'YES' for response in self.pipeline(commands)]
+
+
+    def check(self, queue_name: bytes | str, id: bytes | int) -> bool:
+        return self.check_many(queue_name, [id])[0]
+
+
+    def check_many(self, queue_name: bytes | str, ids: Iterable[bytes | int]) -> list[bool]:
+        commands = [b' '.join([b'IN', encode(queue_name), encode(id)]) for id in ids]
+        return [checked(response) == b'YES' for response in self.pipeline(commands)]
+
+
+    def touch(self, queue_name: bytes | str, id: bytes | int, timeout: float=None) -> bool:
+        '''Продлевает обработку выданного задания на timeout секунд (по умолчанию на время обработки очереди).'''
+        return checked(self.pipeline([touch_command(queue_name, id, timeout)])[0]) == b'YES'
+
+
+    def replay(self, queue_name: bytes | str, count: int=0) -> int:
+        '''Возвращает до count заданий (0 - все) из очереди <queue>.dlq обратно в очередь, возвращает их число.'''
+        return int(checked(self.pipeline([b' '.join([b'REPLAY', encode(queue_name), encode(count)])])[0]))
+
+
+    def save(self) -> bool:
+        return checked(self.pipeline([b'SAVE'])[0]) == b'OK'
+
+
+    def close(self) -> None:
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+class AsyncConnection:
+    '''Асинхронный вариант Connection.'''
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+
+    @classmethod
+    async def open(cls, host: str, port: int) -> 'AsyncConnection':
+        connection = cls(*await asyncio.open_connection(host, port))
+        await connection.pipeline([b'FRAMED'])
+        return connection
+
+
+    async def pipeline(self, commands: list[bytes]) -> list[bytes]:
+        self._writer.write(b''.join(command + b'\n' for command in commands))
+        await self._writer.drain()
+        return [await self._read_response() for _ in commands]
+
+
+    async def _read_response(self) -> bytes:
+        length = int(await self._reader.readuntil(b' '))
+        return (await self._reader.readexactly(length + 1))[:-1]
+
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class AsyncTaskQueueClient:
+    '''Асинхронный клиент сервера очередей с пулом соединений, методы повторяют TaskQueueClient.'''
+    def __init__(self, host: str='127.0.0.1', port: int=5555, pool_size: int=4):
+        self._host = host
+        self._port = port
+        self._pool = asyncio.LifoQueue() # Свободные открытые соединения.
+        self._free = asyncio.Semaphore(pool_size) # Сколько еще соединений можно открыть.
+
+
+    @asynccontextmanager
+    async def _connection(self):
+        if self._pool.empty():
+            connection = await self._opening()
+        else:
+            connection = self._pool.get_nowait()
+
+        try:
+            yield connection
+        except BaseException:
+            connection.close()
+            self._free.release()
+            raise
+        self._pool.put_nowait(connection)
+
+
+    async def _opening(self) -> AsyncConnection:
+        while self._free.locked():
+            try:
+                return await asyncio.wait_for(self._pool.get(), 0.1)
+            except asyncio.TimeoutError:
+                pass
+        await self._free.acquire()
+        try:
+            return await AsyncConnection.open(self._host, self._port)
+        except BaseException:
+            self._free.release()
+            raise
+
+
+    async def pipeline(self, commands: Iterable[bytes]) -> list[bytes]:
+        async with self._connection() as connection:
+            return await connection.pipeline(list(commands))
+
+
+    async def add(self, queue_name: bytes | str, data: bytes, priority: int=None, delay: float=None) -> bytes:
+        return checked((await self.pipeline([add_command(queue_name, data, priority, delay)]))[0])
+
+
+    async def add_many(self, queue_name: bytes | str, datas: list[bytes], priority: int=None, delay: float=None) -> list[bytes]:
+        if not datas:
+            return []
+        return checked((await self.pipeline([add_many_command(queue_name, datas, priority, delay)]))[0]).split(b' ')
+
+
+    async def get(self, queue_name: bytes | str, wait: float=None) -> tuple[bytes, bytes] | None:
+        return parse_task(checked((await self.pipeline([get_command(queue_name, wait)]))[0]))
+
+
+    async def get_many(self, queue_name: bytes | str, count: int) -> list[tuple[bytes, bytes]]:
+        return parse_tasks(checked((await self.pipeline([b' '.join([b'MGET', encode(queue_name), encode(count)])]))[0]))
+
+
+    async def ack(self, queue_name: bytes | str, id: bytes | int) -> bool:
+        return (await self.ack_many(queue_name, [id]))[0]
+
+
+    async def ack_many(self, queue_name: bytes | str, ids: Iterable[bytes | int]) -> list[bool]:
+        commands = [b' '.join([b'ACK', encode(queue_name), encode(id)]) for id in ids]
+        return [checked(response) == b'YES' for response in await self.pipeline(commands)]
+
+
+    async def check(self, queue_name: bytes | str, id: bytes | int) -> bool:
+        return (await self.check_many(queue_name, [id]))[0]
+
+
+    async def check_many(self, queue_name: bytes | str, ids: Iterable[bytes | int]) -> list[bool]:
+        commands = [b' '.join([b'IN', encode(queue_name), encode(id)]) for id in ids]
+        return [checked(response) == b'YES' for response in await self.pipeline(commands)]
+
+
+    async def touch(self, queue_name: bytes | str, id: bytes | int, timeout: float=None) -> bool:
+        return checked((await self.pipeline([touch_command(queue_name, id, timeout)]))[0]) == b'YES'
+
+
+    async def replay(self, queue_name: bytes | str, count: int=0) -> int:
+        return int(checked((await self.pipeline([b' '.join([b'REPLAY', encode(queue_name), encode(count)])]))[0]))
+
+
+    async def save(self) -> bool:
+        return checked((await self.pipeline([b'SAVE']))[0]) == b'OK'
+
+
+    def close(self) -> None:
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
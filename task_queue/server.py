@@ -1,152 +1,1690 @@
-from  collections import deque
-import threading
+from collections.abc import Awaitable, Callable, Iterator
+from collections import Counter, deque
+from typing import NamedTuple
+import multiprocessing
 import argparse
+import asyncio
+import copy
+import bisect
 import socket
 import pickle
+import signal
+import struct
+import heapq
+import mmap
+import time
+import zlib
 import os
 
 
 class Task:
-    def __init__(self, queue: bytes, length: bytes, data: bytes, id: int):
+    priority = 0 # Приоритет заданий из снимков, сделанных до появления приоритетов.
+    due = 0 # Время, раньше которого задание не выдается, у заданий из более старых снимков.
+    deliveries = 0 # Сколько раз задание выдавалось в обработку.
+
+    def __init__(self, queue: bytes, length: bytes, data: bytes, id: int, priority: int=0, due: float=0):
         self.queue = queue
         self.length = length
         self.data = data
         self.id = id
+        self.priority = priority
+        self.due = due
+
+
+    @property
+    def key(self) -> tuple[int, int]:
+        '''Ключ задания в куче готовых заданий: сначала больший приоритет, в одном приоритете - порядок добавления.'''
+        return -self.priority, self.id
+
+
+class StoredPayload(NamedTuple):
+    '''Место содержимого задания в сегменте хранилища.'''
+    segment: int
+    offset: int
+    size: int
+
+
+class PayloadStorage:
+    '''Хранит содержимое заданий в файлах-сегментах, отображенных в память, в куче Python
+       остаются только смещения и длины. Сегмент удаляется, когда в нем не осталось живых заданий.'''
+    SEGMENT_SIZE = 64 * 2 ** 20
+
+    def __init__(self, path: str, segment_size: int=SEGMENT_SIZE):
+        self._path = path
+        self._segment_size = segment_size
+        self._mappings = {} # Открытые отображения сегментов по номеру.
+        self._tasks_count = {} # Число живых заданий в каждом сегменте.
+        self._released = [] # Сегменты без живых заданий, чьи файлы удаляются после сброса журнала.
+        self._segment = max(self._segments(), default=-1) # Сегмент, в который идет запись.
+        self._offset = self._flushed = 0
+
+
+    def _segment_path(self, segment: int) -> str:
+        return f'{self._path}_payloads.{segment}.dat'
+
+
+    def _segments(self) -> list[int]:
+        directory, prefix = os.path.split(f'{self._path}_payloads.')
+        return [int(name[len(prefix):-4]) for name in os.listdir(directory or '.')
+                if name.startswith(prefix) and name.endswith('.dat') and name[len(prefix):-4].isdigit()]
+
+
+    def _mapping(self, segment: int, size: int=0) -> mmap.mmap:
+        if segment not in self._mappings:
+            with open(self._segment_path(segment), 'w+b' if size else 'r+b') as f:
+                if size:
+                    f.truncate(size)
+                self._mappings[segment] = mmap.mmap(f.fileno(), 0)
+        return self._mappings[segment]
+
+
+    def write(self, data: bytes) -> StoredPayload:
+        if self._segment not in self._mappings or self._offset + len(data) > len(self._mappings[self._segment]):
+            self.flush()
+            self._release_segment(self._segment)
+            self._segment += 1
+            self._offset = self._flushed = 0
+            self._mapping(self._segment, max(self._segment_size, len(data)))
+
+        payload = StoredPayload(self._segment, self._offset, len(data))
+        self._mappings[self._segment][self._offset:self._offset + len(data)] = data
+        self._offset += len(data)
+        self._tasks_count[self._segment] = self._tasks_count.get(self._segment, 0) + 1
+        return payload
+
+
+    def read(self, payload: StoredPayload) -> memoryview:
+        '''Возвращает содержимое задания без копирования - срез отображения сегмента.'''
+        return memoryview(self._mapping(payload.segment))[payload.offset:payload.offset + payload.size]
+
+
+    def release(self, payload: StoredPayload) -> None:
+        self._tasks_count[payload.segment] -= 1
+        if payload.segment != self._segment:
+            self._release_segment(payload.segment)
+
+
+    def _release_segment(self, segment: int) -> None:
+        if self._tasks_count.get(segment, 0):
+            return
+        self._tasks_count.pop(segment, None)
+        mapping = self._mappings.pop(segment, None)
+        if mapping is not None:
+            try:
+                mapping.close()
+            except BufferError:
+                pass # Отображение закроется, когда освободится последний срез.
+        self._released.append(segment)
+
+
+    def remove_released(self) -> None:
+        '''Удаляет файлы освободившихся сегментов. Вызывается только после сброса журнала: пока запись ACK,
+           освободившая сегмент, не сохранена, задание после перезапуска еще ссылается на этот файл.'''
+        for segment in self._released:
+            if os.path.exists(self._segment_path(segment)):
+                os.remove(self._segment_path(segment))
+        self._released.clear()
+
+
+    def restore(self, payloads: Iterator[StoredPayload]) -> None:
+        '''Пересчитывает живые задания по сегментам после загрузки состояния и удаляет пустые сегменты.
+           Если файла сегмента с живыми заданиями нет, выбрасывает FileNotFoundError: состояние не загрузилось.'''
+        self._tasks_count = {}
+        for payload in payloads:
+            self._tasks_count[payload.segment] = self._tasks_count.get(payload.segment, 0) + 1
+        segments = self._segments()
+        missing = self._tasks_count.keys() - set(segments)
+        if missing:
+            raise FileNotFoundError(self._segment_path(min(missing)))
+        for segment in segments:
+            self._release_segment(segment)
+        self.remove_released()
+
+
+    def set_aside(self, suffix: str) -> None:
+        '''Переименовывает все сегменты, добавляя suffix, чтобы их можно было разобрать вручную.'''
+        for segment in self._segments():
+            os.replace(self._segment_path(segment), self._segment_path(segment) + suffix)
+
+
+    def flush(self) -> None:
+        '''Сбрасывает на диск страницы текущего сегмента, записанные после предыдущего сброса.'''
+        if self._segment in self._mappings and self._offset > self._flushed:
+            start = self._flushed - self._flushed % mmap.PAGESIZE
+            self._mappings[self._segment].flush(start, self._offset - start)
+            self._flushed = self._offset
+
+
+class CommandParser:
+    '''Разбирает поток байт соединения на отдельные команды.
+       Команды разделяются символом перевода строки, содержимое заданий в командах ADD и MADD
+       читается ровно по указанной длине, поэтому может содержать любые байты.'''
+    def __init__(self):
+        self._buffer = bytearray()
+
+
+    def feed(self, data: bytes) -> list[bytes]:
+        '''Принимает очередную порцию байт, возвращает список полностью полученных команд.'''
+        self._buffer += data
+        commands = []
+        command = self._next_command()
+        while command is not None:
+            commands.append(command)
+            command = self._next_command()
+        return commands
+
+
+    def _next_command(self) -> bytes | None:
+        if self._buffer.startswith((b'ADD ', b'MADD ')):
+            end = self._payload_command_end()
+            if end is None:
+                return None
+            if end >= 0:
+                command = bytes(self._buffer[:end])
+                del self._buffer[:end + 1]
+                return command
+
+        end = self._buffer.find(b'\n')
+        if end < 0:
+            return None
+        command = bytes(self._buffer[:end]).rstrip(b'\r')
+        del self._buffer[:end + 1]
+        return command
+
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+
+    @property
+    def pending(self) -> bytes:
+        '''Байты еще не полученной полностью команды.'''
+        return bytes(self._buffer)
+
+
+    def _payload_command_end(self) -> int | None:
+        '''Возвращает позицию конца команды ADD или MADD, None если команда получена не полностью
+           и -1 если команда записана неверно (тогда она читается до перевода строки).
+           После содержимого может идти приоритет, тогда команда дочитывается до перевода строки.'''
+        position = self.payloads_end()
+        if position is None or position < 0:
+            return position
+        if len(self._buffer) <= position:
+            return None
+        if self._buffer[position] == ord('\n'):
+            return position
+        # Что-то другое вместо пробела тоже дочитывается, и вся команда получает ответ ERROR.
+        end = self._buffer.find(b'\n', position)
+        return end if end >= 0 else None
+
+
+    def payloads_end(self) -> int | None:
+        '''Возвращает позицию сразу за содержимым последнего задания команды ADD или MADD в начале буфера,
+           None если заголовок команды получен не полностью и -1 если команда записана неверно.
+           Содержимое каждого задания читается по указанной перед ним длине, поэтому позиция может быть за концом буфера.
+           Если длина следующего задания еще не получена, возвращается позиция за концом буфера, раньше которой команда не кончается.'''
+        position = self._buffer.find(b' ', self._buffer.find(b' ') + 1) + 1
+        newline = self._buffer.find(b'\n')
+        if newline >= 0 and not 0 < position <= newline:
+            return -1 # Заголовок (команда и очередь) не может содержать перевод строки.
+        checked = 0 # Начало слова, на котором остановился разбор.
+        count = 1
+        if position and self._buffer.startswith(b'MADD '):
+            count, position = self._number(position)
+
+        while position and count:
+            if position >= len(self._buffer):
+                return len(self._buffer) + 1
+            checked = position
+            length, position = self._number(position)
+            position = position and position + length + 1
+            count -= 1
+
+        if not position:
+            if checked and self._buffer.find(b' ', checked) < 0 and self._buffer[checked:].isdigit():
+                return len(self._buffer) + 1 # Длина задания получена только частично.
+            return None if self._buffer.find(b'\n', checked) < 0 else -1
+        return position - 1
+
+
+    def _number(self, position: int) -> tuple[int, int]:
+        '''Читает число, начинающееся с position, возвращает его и позицию следующего слова (0, если числа нет).'''
+        end = self._buffer.find(b' ', position)
+        number = bytes(self._buffer[position:end])
+        if end < 0 or not number.isdigit():
+            return 0, 0
+        return int(number), end + 1
+
+
+class BinaryCommand(NamedTuple):
+    '''Команда двоичного протокола. Аргумент - идентификатор задания для ACK и IN, время ожидания GET,
+       задержка выдачи ADD и время продления TOUCH в миллисекундах (0 - время обработки очереди).
+       Содержимое TOUCH - идентификатор задания, 8-байтовое число.'''
+    name: bytes
+    queue: bytes
+    priority: int
+    argument: int
+    payload: bytes | memoryview
+
+
+class BinaryParser:
+    '''Разбирает поток байт соединения двоичного протокола на команды. Команда - заголовок фиксированной длины
+       (код команды, длина имени очереди, приоритет, аргумент, длина содержимого), имя очереди и содержимое.
+       Ответ - заголовок (состояние, идентификатор задания, длина содержимого) и содержимое выданного задания.
+       Коды команд больше 0x80, поэтому соединение двоичного протокола отличается от текстового по первому байту.'''
+    REQUEST = struct.Struct('>BBhQI')
+    RESPONSE = struct.Struct('>B3xQI')
+    TASK_ID = struct.Struct('>Q') # Содержимое команды TOUCH.
+    COMMANDS = {0x81: b'ADD', 0x82: b'GET', 0x83: b'ACK', 0x84: b'IN', 0x85: b'TOUCH'}
+    OK, NONE, ERROR = 0, 1, 2 # Состояния ответа: выполнено (YES), нет задания (NONE, NO), ошибка.
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+
+    @classmethod
+    def detect(cls, data: bytes) -> bool:
+        return bool(data) and data[0] in cls.COMMANDS
+
+
+    def feed(self, data: bytes) -> list[BinaryCommand]:
+        '''Принимает очередную порцию байт, возвращает список полностью полученных команд.'''
+        self._buffer += data
+        if len(self._buffer) < self.REQUEST.size:
+            return []
+        _, queue_size, _, _, size = self.REQUEST.unpack_from(self._buffer)
+        if len(self._buffer) < self.REQUEST.size + queue_size + size:
+            return [] # Большое содержимое собирается в буфере без копирования, пока не придет целиком.
+
+        # Содержимое команд - срезы memoryview полученного буфера, без копирования. Буфер больше не меняется,
+        # следующие байты собираются в новом, туда копируется только неполная последняя команда.
+        buffer = memoryview(self._buffer)
+        self._buffer = bytearray()
+        commands = []
+        position = 0
+        while len(buffer) - position >= self.REQUEST.size:
+            code, queue_size, priority, argument, size = self.REQUEST.unpack_from(buffer, position)
+            queue_start = position + self.REQUEST.size
+            payload_start = queue_start + queue_size
+            end = payload_start + size
+            if len(buffer) < end:
+                break
+            commands.append(BinaryCommand(self.COMMANDS.get(code, b''), bytes(buffer[queue_start:payload_start]), priority,
+                                          argument, buffer[payload_start:end]))
+            position = end
+        self._buffer += buffer[position:]
+        return commands
+
+
+    @classmethod
+    def pack(cls, command: BinaryCommand) -> list[bytes]:
+        code = next(code for code, name in cls.COMMANDS.items() if name == command.name)
+        return [cls.REQUEST.pack(code, len(command.queue), command.priority, command.argument, len(command.payload)),
+                command.queue, command.payload]
+
+
+    @classmethod
+    def response(cls, status: int, id: int=0, payload: bytes | memoryview=b'') -> list[bytes | memoryview]:
+        '''Возвращает части ответа, содержимое задания не склеивается с заголовком и не копируется.'''
+        return [cls.RESPONSE.pack(status, id, len(payload)), payload]
+
+
+class Journal:
+    '''Журнал операций сервера. Записи только дописываются в конец текущего сегмента,
+       каждая запись - pickle кортежа с префиксом длины. Сегменты нумеруются по возрастанию,
+       при сворачивании журнала в снимок начинается новый сегмент, а старые удаляются.'''
+    def __init__(self, path: str, fsync_batch: int):
+        self._path = path
+        self._fsync_batch = fsync_batch # Сколько записей можно накопить до fsync, 0 - не вызывать fsync.
+        self._unsynced = 0
+        self.synced_at = time.time() # Время последнего fsync, по нему видно отставание записи на диск.
+        self.segment = max(self.segments(), default=-1) + 1
+        self._file = open(self._segment_path(self.segment), 'ab')
+
+
+    def _segment_path(self, segment: int) -> str:
+        return f'{self._path}_journal.{segment}.log'
+
+
+    def segments(self) -> list[int]:
+        '''Возвращает номера имеющихся на диске сегментов журнала по возрастанию.'''
+        directory, prefix = os.path.split(f'{self._path}_journal.')
+        names = os.listdir(directory or '.')
+        return sorted(int(name[len(prefix):-4]) for name in names
+                      if name.startswith(prefix) and name.endswith('.log') and name[len(prefix):-4].isdigit())
+
+
+    @property
+    def size(self) -> int:
+        return self._file.tell()
+
+
+    @property
+    def unsynced(self) -> int:
+        '''Число записей, еще не сброшенных на диск через fsync.'''
+        return self._unsynced
+
+
+    @staticmethod
+    def encode(*record) -> bytes:
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        return len(payload).to_bytes(4, 'big') + payload
+
+
+    @staticmethod
+    def decode(buffer: bytearray) -> list[tuple]:
+        '''Забирает из буфера все полностью полученные записи, например присланные ведущим сервером.'''
+        records = []
+        position = 0
+        while len(buffer) >= position + 4:
+            size = int.from_bytes(buffer[position:position + 4], 'big')
+            if len(buffer) < position + 4 + size:
+                break
+            records.append(pickle.loads(buffer[position + 4:position + 4 + size]))
+            position += 4 + size
+        del buffer[:position]
+        return records
+
+
+    def write(self, *record) -> None:
+        self.append(self.encode(*record))
+
+
+    def append(self, frame: bytes) -> None:
+        '''Дописывает уже сериализованную запись.'''
+        self._file.write(frame)
+        self._unsynced += 1
+
+
+    @property
+    def unsynced(self) -> int:
+        '''Сколько записей еще не сброшено на диск через fsync.'''
+        return self._unsynced
+
+
+    def sync(self, force: bool=False) -> None:
+        '''Сбрасывает записи в ОС и вызывает fsync, если накопилось достаточно записей.'''
+        self._file.flush()
+        if self._unsynced and (force or self._fsync_batch and self._unsynced >= self._fsync_batch):
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self.synced_at = time.time()
+
+
+    def rotate(self) -> int:
+        '''Закрывает текущий сегмент и начинает новый, возвращает номер нового сегмента.'''
+        self.sync(force=True)
+        self._file.close()
+        self.segment += 1
+        self._file = open(self._segment_path(self.segment), 'ab')
+        return self.segment
+
+
+    def read(self, segment: int) -> Iterator[tuple]:
+        '''Возвращает записи сегмента. Недописанная при сбое последняя запись отбрасывается.'''
+        with open(self._segment_path(segment), 'rb') as f:
+            while len(header := f.read(4)) == 4:
+                payload = f.read(int.from_bytes(header, 'big'))
+                if len(payload) < int.from_bytes(header, 'big'):
+                    return
+                yield pickle.loads(payload)
+
+
+    def remove_before(self, segment: int) -> None:
+        for old_segment in self.segments():
+            if old_segment < segment:
+                os.remove(self._segment_path(old_segment))
+
+
+    def set_aside_before(self, segment: int, suffix: str) -> None:
+        '''Переименовывает сегменты до segment, добавляя suffix, после чего они больше не читаются как журнал.'''
+        for old_segment in self.segments():
+            if old_segment < segment:
+                os.replace(self._segment_path(old_segment), self._segment_path(old_segment) + suffix)
+
+
+    def close(self) -> None:
+        self.sync(force=True)
+        self._file.close()
+
+
+class Metrics:
+    '''Счетчики событий очередей и гистограммы задержек команд. Обновляются на каждой команде,
+       поэтому хранятся в простых словарях и списках, накопительные суммы гистограмм считаются только при выводе.'''
+    EVENTS = (b'added', b'got', b'acked', b'expired', b'dead')
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1.0) # Границы корзин в секундах.
+    SERVER_HELP = {'queues': 'Queues known to the server.',
+                   'uptime': 'Seconds since the server started.',
+                   'journal_unsynced': 'Journal records not flushed with fsync yet.',
+                   'journal_sync_age': 'Seconds since the last journal fsync.',
+                   'journal_bytes': 'Size of the current journal segment in bytes.',
+                   'compacting': 'Whether a snapshot is being written.'}
+
+    def __init__(self):
+        self.started = time.time()
+        self.events = Counter() # Число событий по (событие, очередь).
+        self._latencies = {} # Число команд в каждой корзине задержки (последняя - больше всех границ) по имени команды.
+        self._latency_sums = Counter() # Суммарное время выполнения по имени команды.
+
+
+    def count(self, event: bytes, queue: bytes, number: int=1) -> None:
+        self.events[(event, queue)] += number
+
+
+    def observe(self, command: bytes, latency: float) -> None:
+        if command not in self._latencies:
+            self._latencies[command] = [0] * (len(self.LATENCY_BUCKETS) + 1)
+        self._latencies[command][bisect.bisect_left(self.LATENCY_BUCKETS, latency)] += 1
+        self._latency_sums[command] += latency
+
+
+    def latency_lines(self) -> list[str]:
+        '''Возвращает гистограммы задержек в текстовом формате Prometheus.'''
+        lines = ['# HELP task_queue_command_seconds Command execution time.', '# TYPE task_queue_command_seconds histogram']
+        for command, buckets in sorted(self._latencies.items()):
+            name = command.decode('utf-8')
+            total = 0
+            for bound, number in zip((*self.LATENCY_BUCKETS, '+Inf'), buckets):
+                total += number
+                lines.append(f'task_queue_command_seconds_bucket{{command="{name}",le="{bound}"}} {total}')
+            lines.append(f'task_queue_command_seconds_sum{{command="{name}"}} {self._latency_sums[command]:.6f}')
+            lines.append(f'task_queue_command_seconds_count{{command="{name}"}} {total}')
+        return lines
+
+
+class Replica:
+    '''Резервный сервер, подключенный к ведущему: сколько записей журнала ему отправлено и сколько он подтвердил.'''
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.sent = 0
+        self.acknowledged = 0
+        self.closed = False
+        self._progress = asyncio.Event() # Устанавливается при каждом подтверждении и при отключении.
+
+
+    def send(self, frame: bytes) -> None:
+        self.writer.write(frame)
+        self.sent += 1
+
+
+    def acknowledge(self, acknowledged: int) -> None:
+        self.acknowledged = acknowledged
+        self._progress.set()
+
+
+    def close(self) -> None:
+        self.closed = True
+        self._progress.set()
+
+
+    async def synced(self, timeout: float) -> bool:
+        '''Ждет подтверждения всех записей, отправленных до вызова, или отключения резервного сервера.
+           Возвращает False, если подтверждение не пришло за timeout секунд.'''
+        sent = self.sent
+        deadline = time.monotonic() + timeout
+        while self.acknowledged < sent and not self.closed:
+            self._progress.clear()
+            try:
+                await asyncio.wait_for(self._progress.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                return False
+        return True
 
 
 class TaskQueueServer:
-    def __init__(self, ip: str, port: int, path: str, timeout: int):
+    EXPIRING_INTERVAL = 0.1 # Как часто в асинхронном режиме проверяются сроки заданий, в секундах.
+    RECEIVE_SIZE = 65536 # Сколько байт команды читается за раз до того, как известна длина задания.
+    TAIL_WAIT = 0.05 # Сколько секунд в режиме одной команды ждать продолжения команды после содержимого заданий.
+    DEAD_LETTER_SUFFIX = b'.dlq' # Окончание имени очереди, в которую уходят задания, исчерпавшие число выдач.
+    REPLICA_TIMEOUT = 1.0 # Сколько секунд ведущий ждет подтверждения записей от резервного сервера, прежде чем отключить его.
+    LEADER_RETRY = 0.1 # Первая пауза резервного сервера перед повторным подключением к ведущему, в секундах.
+    LEADER_RETRY_MAX = 5.0 # Пауза удваивается после каждой неудачи до этого значения.
+
+    def __init__(self, ip: str, port: int, path: str, timeout: int, fsync_batch: int=1, compaction_size: int=64 * 2 ** 20,
+                 mmap_storage: bool=False, max_deliveries: int=0, leader: tuple[str, int]=None,
+                 queue_timeouts: list[tuple[bytes, float]]=(), replication: bool=False):
         self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._server.bind((ip, port))
         self._timeout = timeout
+        self._queue_timeouts = dict(queue_timeouts) # Время на обработку задания в очередях, где оно отличается от timeout.
+        self._max_deliveries = max_deliveries # После скольких выдач задание уходит в очередь <queue>.dlq, 0 - без ограничения.
 
         self._path = path
-        self._tasks_queues = {} # Хранилище очередей с заданиями.
-        self._tasks_in_processing = {} # Хранилище задании взятых в обработку.
+        self._fsync_batch = fsync_batch
+        self._compaction_size = compaction_size # Размер сегмента журнала, после которого он сворачивается в снимок.
+        self._journal = None # Открывается при запуске, после восстановления состояния.
+        self._compacting = None # Процесс записи снимка и номер сегмента, с которого снимок актуален.
+        self._mmap_storage = mmap_storage # Складывать содержимое новых заданий в сегменты хранилища.
+        self._storage = None # Открывается при запуске, читает и ранее сохраненные в сегменты задания.
+        self._tasks_queues = {} # Очереди готовых к выдаче заданий: куча пар (минус приоритет, идентификатор).
+        self._tasks_in_processing = {} # Сроки возврата в очередь заданий взятых в обработку.
+        self._tasks_delayed = {} # Отложенные задания очереди: время, с которого задание можно выдавать, по идентификатору.
+        self._deadlines = [] # Куча сроков возврата заданий в очередь и выдачи отложенных: (срок, очередь, идентификатор).
+        self._tasks_ids = {} # Следующий свободный идентификатор задания для каждой очереди.
+        self._tasks_index = {} # Все задания очереди (в очереди и в обработке) по идентификатору.
+        self._waiters = {} # Клиенты, ждущие задание очереди в блокирующем GET, в порядке прихода.
+        # Проверка, что клиент, чьи команды сейчас выполняются, закрыл соединение. Ее получает каждый ждущий GET.
+        self._disconnected = lambda: False
+        self._loop = None # Цикл событий асинхронного режима, только в нем GET может ждать задание.
+        self._metrics = Metrics()
+        self._replication = replication # Принимать ли подключения резервных серверов командой REPLICATE.
+        self._replicas = [] # Подключенные резервные серверы, им отправляется каждая запись журнала.
+        self._logged = 0 # Число записей журнала с запуска, по нему видно, записал ли пакет команд что-нибудь.
+        self._leader = leader # Адрес ведущего сервера, пока этот сервер резервный.
+        self._following = None # Задача, получающая записи журнала ведущего сервера.
+
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._server.getsockname()
 
 
     def _add_task(self, queue: bytes, length: bytes, data: bytes) -> bytes:
-        '''Принимает имя очереди, длину задания и содержимое задания. Добавляет задание в очередь,
-           возвращает уникальный идентификатор задания. Если такой очереди нет, то создает ее и добавляет задание.'''
-        id_task = self._create_id(queue) if queue in self._tasks_queues else 0
-        if id_task:
-            self._tasks_queues[queue].append(Task(queue, length, data, id_task))
+        '''Принимает имя очереди, длину задания и содержимое задания, после которого через пробел может идти приоритет.
+           Добавляет задание в очередь, возвращает уникальный идентификатор задания. Если такой очереди нет, то создает ее и добавляет задание.'''
+        priority, delay = 0, 0
+        if len(data) > int(length):
+            data, (priority, delay) = data[:int(length)], self._options(data[int(length):])
+        return str(self._enqueue(queue, length, data, priority, delay)).encode('utf-8')
+
+
+    def _options(self, tail: bytes) -> tuple[int, float]:
+        '''Читает записанные через пробел после содержимого заданий команды приоритет
+           и необязательную задержку выдачи в секундах.'''
+        options = tail[1:].split(b' ')
+        if tail[:1] != b' ' or len(options) > 2:
+            raise ValueError
+        delay = float(options[1]) if len(options) > 1 else 0
+        if not 0 <= delay < float('inf'):
+            raise ValueError
+        return int(options[0]), delay
+
+
+    def _enqueue(self, queue: bytes, length: bytes, data: bytes, priority: int, delay: float) -> int:
+        if int(length) != len(data):
+            raise ValueError
+        id_task = self._create_id(queue)
+        if self._mmap_storage:
+            data = self._storage.write(data)
+        due = time.time() + delay if delay else 0
+        self._log(b'ADD', queue, id_task, length, data, priority, due)
+        task = Task(queue, length, data, id_task, priority, due)
+        self._tasks_index.setdefault(queue, {})[id_task] = task
+        self._metrics.count(b'added', queue)
+        if due:
+            self._tasks_delayed.setdefault(queue, {})[id_task] = due
+            heapq.heappush(self._deadlines, (due, queue, id_task))
         else:
-            self._tasks_queues[queue] = deque((Task(queue, length, data, id_task), ))
-        return str(id_task).encode('utf-8')
+            self._schedule(task)
+        return id_task
+
+
+    def _schedule(self, task: Task) -> None:
+        '''Выставляет задание в очередь готовых к выдаче и сразу выдает его ждущему клиенту, если такой есть.'''
+        heapq.heappush(self._tasks_queues.setdefault(task.queue, []), task.key)
+        self._waking(task.queue)
+
+
+    def _get_task(self, queue: bytes, wait: bytes=b'0') -> bytes | asyncio.Future:
+        '''Принимает имя очереди, возвращает уникальный идентификатор задания, длину задания и содержимое задания.
+           Если заданий нет и указано время ожидания в секундах, в асинхронном режиме возвращает future,
+           которое получит задание, как только оно появится в очереди, или NONE по истечении ожидания.'''
+        task = self._take_task(queue)
+        if task is None and float(wait) > 0 and self._loop:
+            return self._waiting(queue, float(wait), self._task_response)
+        return self._task_response(task)
 
 
-    def _get_task(self, queue: bytes) -> bytes:
-        '''Принимает имя очереди, возвращает уникальный идентификатор задания, длину задания и содержимое задания.'''
-        if queue not in self._tasks_queues or not self._tasks_queues[queue]:
+    def _task_response(self, task: Task | None) -> bytes:
+        if task is None:
             return b'NONE'
+        return b' '.join([str(task.id).encode('utf-8'), task.length, self._payload(task)])
+
+
+    def _take_task(self, queue: bytes) -> Task | None:
+        '''Выдает в обработку готовое задание очереди с наибольшим приоритетом, None если таких нет.'''
+        if not self._tasks_queues.get(queue):
+            return None
+
+        _, id = heapq.heappop(self._tasks_queues[queue])
+        task = self._tasks_index[queue][id]
+        task.deliveries += 1
+        deadline = time.time() + self._queue_timeouts.get(queue, self._timeout)
+        self._tasks_in_processing[(queue, task.id)] = deadline
+        self._log(b'GET', queue, task.id, deadline)
+        heapq.heappush(self._deadlines, (deadline, queue, task.id))
+        self._metrics.count(b'got', queue)
+        return task
+
+
+    def _waiting(self, queue: bytes, wait: float, responding: Callable[[Task | None], object]) -> asyncio.Future:
+        '''Возвращает future, которое получит ответ responding на выданное задание или на None по истечении ожидания.
+           Ответ зависит от протокола соединения, поэтому ждущий клиент передает свою функцию ответа.'''
+        waiter = self._loop.create_future()
+        waiting = (waiter, responding, self._disconnected)
+        self._waiters.setdefault(queue, deque()).append(waiting)
+        self._loop.call_later(wait, self._stop_waiting, queue, waiting)
+        return waiter
 
-        task = self._tasks_queues[queue].popleft()
-        self._tasks_in_processing[(queue, task.id)] = (task, threading.Timer(self._timeout, self._return_to_queue, args=(queue, task.id)))
-        self._tasks_in_processing[(queue, task.id)][1].start()
-        return b' '.join([str(task.id).encode('utf-8'), task.length, task.data])
+
+    def _stop_waiting(self, queue: bytes, waiting: tuple[asyncio.Future, Callable, Callable]) -> None:
+        waiter, responding, _ = waiting
+        if not waiter.done():
+            self._waiters[queue].remove(waiting)
+            waiter.set_result(responding(None))
+
+
+    def _waking(self, queue: bytes) -> None:
+        '''Выдает появившиеся в очереди задания ждущим их клиентам, каждое задание - одному клиенту.
+           Клиенты, закрывшие соединение, пропускаются, иначе задание ушло бы в обработку никому.'''
+        waiters = self._waiters.get(queue)
+        while waiters and self._tasks_queues[queue]:
+            waiter, responding, disconnected = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(responding(None if disconnected() else self._take_task(queue)))
+
+
+    def _add_tasks(self, queue: bytes, count: bytes, payloads: bytes=b'') -> bytes:
+        '''Принимает имя очереди, число заданий и их длины с содержимым: <length> <data> <length> <data> ... [<priority> [<delay>]]
+           Добавляет все задания в очередь с одним приоритетом и задержкой, возвращает их идентификаторы через пробел.'''
+        tasks = []
+        position = 0
+        for _ in range(int(count)):
+            length_end = payloads.index(b' ', position)
+            length = payloads[position:length_end]
+            position = length_end + 1 + int(length)
+            tasks.append((length, payloads[length_end + 1:position]))
+            position += 1
+        priority, delay = self._options(payloads[position - 1:]) if position <= len(payloads) else (0, 0)
+        if any(int(length) != len(data) for length, data in tasks):
+            raise ValueError
+
+        return b' '.join([str(self._enqueue(queue, length, data, priority, delay)).encode('utf-8') for length, data in tasks])
+
+
+    def _get_tasks(self, queue: bytes, count: bytes) -> bytes:
+        '''Принимает имя очереди и число заданий, выдает в обработку до count заданий.
+           Возвращает число выданных заданий и для каждого идентификатор, длину и содержимое.'''
+        tasks = []
+        for _ in range(int(count)):
+            task = self._get_task(queue)
+            if task == b'NONE':
+                break
+            tasks.append(task)
+
+        if not tasks:
+            return b'NONE'
+        return b' '.join([str(len(tasks)).encode('utf-8'), *tasks])
 
 
     def _ack_task(self, queue: bytes, id: bytes) -> bytes:
         '''Принимает очередь и идентификатор задания, возвращает подтверждение выполнения.'''
         id = int(id)
         if (queue, id) in self._tasks_in_processing:
-            self._tasks_in_processing[(queue, id)][1].cancel()
             del self._tasks_in_processing[(queue, id)]
+            task = self._tasks_index[queue].pop(id)
+            self._log(b'ACK', queue, id)
+            self._metrics.count(b'acked', queue)
+            if isinstance(task.data, StoredPayload):
+                self._storage.release(task.data)
             return b'YES'
         else:
             return b'NO'
 
 
+    def _touch_task(self, queue: bytes, id: bytes, timeout: bytes=None) -> bytes:
+        '''Принимает очередь, идентификатор выданного задания и необязательное время в секундах. Продлевает обработку задания
+           на это время (по умолчанию на время обработки очереди) от текущего момента, возвращает YES, если задание в обработке.'''
+        id = int(id)
+        timeout = self._queue_timeouts.get(queue, self._timeout) if timeout is None else float(timeout)
+        if not 0 < timeout < float('inf'):
+            raise ValueError
+        if (queue, id) not in self._tasks_in_processing:
+            return b'NO'
+
+        # Прежняя запись кучи сроков останется и будет отброшена, так как срок задания уже другой.
+        deadline = time.time() + timeout
+        self._tasks_in_processing[(queue, id)] = deadline
+        self._log(b'TOUCH', queue, id, deadline)
+        heapq.heappush(self._deadlines, (deadline, queue, id))
+        return b'YES'
+
+
     def _in_task(self, queue: bytes, id: bytes) -> bytes:
         '''Принимает очередь и идентификатор задания, возвращает подтверждение наличия задания в очереди.'''
-        id = int(id)
-        if (queue, id) in self._tasks_in_processing \
-           or (queue in self._tasks_queues and [task for task in self._tasks_queues[queue] if task.id == int(id)]):
-           return b'YES'
+        if int(id) in self._tasks_index.get(queue, ()):
+            return b'YES'
         return b'NO'
 
 
     def _return_to_queue(self, queue: bytes, id: int) -> None:
-        '''Принимает очередь и идентификатор задания, возвращает не выполненное задание обратно в очередь.'''
-        if not self._tasks_queues[queue] or (self._tasks_queues[queue] and self._tasks_queues[queue][-1].id < id):
-            self._tasks_queues[queue].append(self._tasks_in_processing[(queue, id)][0])
-        else:
-            for task in self._tasks_queues[queue]:
-                if task.id > id:
-                    self._tasks_queues[queue].insert(self._tasks_queues[queue].index(task), self._tasks_in_processing[(queue, id)][0])
-                    break
+        '''Принимает очередь и идентификатор задания, возвращает не выполненное задание обратно в очередь.
+           Куча сохраняет порядок приоритетов и добавления заданий, поэтому вставка стоит O(log n).
+           Задание, выданное уже max_deliveries раз, переносится в очередь <queue>.dlq.'''
         del self._tasks_in_processing[(queue, id)]
+        self._metrics.count(b'expired', queue)
+        task = self._tasks_index[queue][id]
+        if self._max_deliveries and task.deliveries >= self._max_deliveries and not queue.endswith(self.DEAD_LETTER_SUFFIX):
+            self._metrics.count(b'dead', queue)
+            self._move_task(queue, id, queue + self.DEAD_LETTER_SUFFIX)
+            return
+        self._log(b'EXPIRE', queue, id)
+        self._schedule(task)
+
+
+    def _move_task(self, queue: bytes, id: int, target: bytes) -> None:
+        '''Переносит задание в очередь target под новым идентификатором и со сброшенным счетчиком выдач.'''
+        target_id = self._create_id(target)
+        self._log(b'MOVE', queue, id, target, target_id)
+        self._schedule(self._relocate(queue, id, target, target_id))
+
+
+    def _relocate(self, queue: bytes, id: int, target: bytes, target_id: int) -> Task:
+        task = self._tasks_index[queue].pop(id)
+        task.queue, task.id, task.deliveries = target, target_id, 0
+        self._tasks_index.setdefault(target, {})[target_id] = task
+        return task
+
+
+    def _replay_dead_tasks(self, queue: bytes, count: bytes=b'0') -> bytes:
+        '''Принимает имя очереди и число заданий (0 - все), возвращает до count готовых к выдаче заданий
+           из очереди <queue>.dlq обратно в очередь. Возвращает число возвращенных заданий.'''
+        dead_queue = queue + self.DEAD_LETTER_SUFFIX
+        tasks = self._tasks_queues.get(dead_queue, [])
+        if int(count) < 0:
+            raise ValueError
+        replayed = min(int(count) or len(tasks), len(tasks))
+        for _ in range(replayed):
+            _, id = heapq.heappop(tasks)
+            self._move_task(dead_queue, id, queue)
+        return str(replayed).encode('utf-8')
+
+
+    def _in_flight(self, queue: bytes) -> int:
+        '''Число заданий очереди, выданных в обработку: все задания очереди, кроме готовых к выдаче и отложенных.'''
+        return len(self._tasks_index.get(queue, ())) - len(self._tasks_queues.get(queue, ())) - len(self._tasks_delayed.get(queue, ()))
+
+
+    def _stats(self, queue: bytes=None) -> bytes:
+        '''Возвращает статистику очереди, а без имени очереди - всего сервера, одной строкой пар <name> <value>:
+           число готовых, выданных в обработку и отложенных заданий и счетчики добавленных, выданных, подтвержденных
+           и возвращенных по таймауту заданий. Для сервера добавляются время работы и отставание журнала от диска.'''
+        queues = list(self._tasks_index) if queue is None else [queue]
+        stats = {'depth': sum(len(self._tasks_queues.get(name, ())) for name in queues),
+                 'in_flight': sum(self._in_flight(name) for name in queues),
+                 'delayed': sum(len(self._tasks_delayed.get(name, ())) for name in queues)}
+        for event in Metrics.EVENTS:
+            stats[event.decode('utf-8')] = sum(self._metrics.events[(event, name)] for name in queues)
+        if queue is None:
+            stats.update(self._server_stats())
+        return ' '.join(f'{name} {value}' for name, value in stats.items()).encode('utf-8')
+
+
+    def _server_stats(self) -> dict[str, int | str]:
+        return {'queues': len(self._tasks_index),
+                'uptime': f'{time.time() - self._metrics.started:.3f}',
+                'journal_unsynced': self._journal.unsynced,
+                'journal_sync_age': f'{time.time() - self._journal.synced_at:.3f}',
+                'journal_bytes': self._journal.size,
+                'compacting': int(bool(self._compacting))}
+
+
+    def _metrics_text(self) -> bytes:
+        '''Возвращает метрики сервера в текстовом формате Prometheus.'''
+        queues = sorted(self._tasks_index)
+        lines = self._metric_lines('depth', 'gauge', 'Tasks ready to be given out.',
+                                   [(queue_label(queue), len(self._tasks_queues.get(queue, ()))) for queue in queues])
+        lines += self._metric_lines('in_flight', 'gauge', 'Tasks given out and not acknowledged yet.',
+                                    [(queue_label(queue), self._in_flight(queue)) for queue in queues])
+        lines += self._metric_lines('delayed', 'gauge', 'Tasks waiting for their delivery time.',
+                                    [(queue_label(queue), len(self._tasks_delayed.get(queue, ()))) for queue in queues])
+        lines += self._metric_lines('tasks_total', 'counter', 'Task events by queue: added, got, acked, expired.',
+                                    [(queue_label(queue, f',event="{event.decode("utf-8")}"'), number)
+                                     for (event, queue), number in sorted(self._metrics.events.items())])
+        lines += self._metrics.latency_lines()
+        for name, value in self._server_stats().items():
+            lines += self._metric_lines(name, 'gauge', Metrics.SERVER_HELP[name], [('', value)])
+        return '\n'.join(lines).encode('utf-8')
+
+
+    @staticmethod
+    def _metric_lines(name: str, kind: str, description: str, samples: list[tuple[str, int | str]]) -> list[str]:
+        return [f'# HELP task_queue_{name} {description}', f'# TYPE task_queue_{name} {kind}',
+                *(f'task_queue_{name}{labels} {value}' for labels, value in samples)]
+
+
+    def _payload(self, task: Task) -> bytes | memoryview:
+        if isinstance(task.data, StoredPayload):
+            return self._storage.read(task.data)
+        return task.data
+
+
+    def _expire_tasks(self) -> None:
+        '''Возвращает в очередь все задания, срок обработки которых истек, и выставляет в очередь отложенные задания,
+           время выдачи которых наступило. Записи кучи, задания которых уже подтверждены, просто отбрасываются.'''
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, queue, id = heapq.heappop(self._deadlines)
+            if self._tasks_in_processing.get((queue, id)) == deadline:
+                self._return_to_queue(queue, id)
+            elif self._tasks_delayed.get(queue, {}).get(id) == deadline:
+                del self._tasks_delayed[queue][id]
+                self._schedule(self._tasks_index[queue][id])
 
 
     def _create_id(self, queue: bytes) -> int:
-        if queue in self._tasks_queues and self._tasks_queues[queue]:
-            return max(self._tasks_queues[queue], key=lambda task: task.id).id + 1
-        elif queue in self._tasks_queues and not self._tasks_queues[queue]:
-            queue_ids = tuple((task_id for queue_task, task_id in self._tasks_in_processing if queue_task == queue))
-            return max(queue_ids) + 1 if queue_ids else 0
-        return 0
+        '''Возвращает следующий идентификатор задания очереди. Идентификаторы только растут
+           и не используются повторно, даже если очередь была полностью разобрана.'''
+        id_task = self._tasks_ids.get(queue, 0)
+        self._tasks_ids[queue] = id_task + 1
+        return id_task
+
+
+    def _log(self, *record) -> None:
+        '''Записывает операцию в журнал и отправляет ее резервным серверам. Им содержимое заданий
+           из хранилища отправляется само, а не ссылкой на сегмент этого сервера.'''
+        frame = Journal.encode(*record)
+        self._journal.append(frame)
+        self._logged += 1
+        if not self._replicas:
+            return
+        if record[0] == b'ADD' and isinstance(record[4], StoredPayload):
+            frame = Journal.encode(*record[:4], bytes(self._storage.read(record[4])), *record[5:])
+        for replica in self._replicas:
+            replica.send(frame)
+
+
+    def _replica_snapshot(self) -> bytes:
+        '''Возвращает запись с полным состоянием очередей для подключившегося резервного сервера.'''
+        index = {queue: dict(tasks) for queue, tasks in self._tasks_index.items()}
+        for tasks in index.values():
+            for id, task in tasks.items():
+                if isinstance(task.data, StoredPayload):
+                    tasks[id] = copy.copy(task)
+                    tasks[id].data = bytes(self._storage.read(task.data))
+        return Journal.encode(b'SNAPSHOT', self._tasks_in_processing, self._tasks_ids, index)
+
+
+    async def _serving_replica(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Отправляет подключившемуся резервному серверу состояние очередей, а затем каждую новую запись журнала.
+           Резервный сервер подтверждает число примененных записей 8-байтовым числом.'''
+        replica = Replica(writer)
+        replica.send(self._replica_snapshot())
+        self._replicas.append(replica)
+        try:
+            while acknowledged := await reader.readexactly(8):
+                replica.acknowledge(int.from_bytes(acknowledged, 'big'))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._drop_replica(replica)
+
+
+    def _drop_replica(self, replica: Replica) -> None:
+        '''Отключает резервный сервер: ведущий больше не отправляет ему записи и не ждет его подтверждений.'''
+        if replica in self._replicas:
+            self._replicas.remove(replica)
+        replica.close()
+        replica.writer.close()
+
+
+    async def _replicating(self) -> None:
+        '''Ждет, пока резервные серверы подтвердят уже отправленные записи, чтобы клиент не получил ответ
+           на операцию, которой нет на резервном сервере. Резервный сервер, не подтвердивший записи
+           за REPLICA_TIMEOUT секунд, отключается, чтобы не останавливать ведущего.'''
+        replicas = list(self._replicas)
+        synced = await asyncio.gather(*(replica.synced(self.REPLICA_TIMEOUT) for replica in replicas))
+        for replica, replica_synced in zip(replicas, synced):
+            if not replica_synced:
+                print('Резервный сервер не подтвердил записи журнала вовремя и отключен.')
+                self._drop_replica(replica)
+
+
+    async def _following_leader(self) -> None:
+        '''Пока сервер резервный, получает записи ведущего. Если ведущий недоступен, отключился или не принял
+           REPLICATE, подключается заново с паузой, которая удваивается после каждой неудачи.
+           При каждом подключении ведущий заново присылает полное состояние.'''
+        delay = self.LEADER_RETRY
+        while self._leader is not None:
+            try:
+                if await self._replicating_leader():
+                    delay = self.LEADER_RETRY
+                print('Ведущий сервер отключился, резервный сервер подключается к нему заново.')
+            except (OSError, ValueError) as error:
+                print(f'Не удалось получить журнал ведущего сервера: {error!r}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.LEADER_RETRY_MAX)
+
+
+    async def _replicating_leader(self) -> bool:
+        '''Получает от ведущего сервера состояние и записи журнала, применяет их и пишет в свой журнал.
+           После сброса каждой порции записей на диск подтверждает ведущему число примененных записей.
+           Возвращает True, если ведущий прислал состояние.'''
+        reader, writer = await asyncio.open_connection(*self._leader)
+        writer.write(b'REPLICATE\n')
+        buffer = bytearray()
+        applied = 0
+        try:
+            while data := await reader.read(65536):
+                buffer += data
+                # Запись журнала - длина и pickle, который начинается с кода 0x80. Иначе ведущий ответил текстом:
+                # ERROR, если он запущен без -R, или STANDBY, если он сам резервный.
+                if not applied and len(buffer) > 4 and buffer[4] != pickle.PROTO[0]:
+                    raise ValueError(f'ведущий ответил {bytes(buffer[:64])!r} вместо состояния')
+                for record in Journal.decode(buffer):
+                    if not applied and record[0] != b'SNAPSHOT':
+                        raise ValueError(f'ведущий прислал {record[0]!r} вместо состояния')
+                    self._journal.write(*record)
+                    self._replaying(*record)
+                    applied += 1
+                self._persisting()
+                writer.write(applied.to_bytes(8, 'big'))
+            return applied > 0
+        finally:
+            writer.close()
+
+
+    def _promote(self) -> bytes:
+        '''Делает резервный сервер ведущим: прекращает получать журнал и начинает выдавать задания.'''
+        if self._leader is None:
+            return b'OK'
+        self._leader = None
+        if self._following:
+            self._following.cancel()
+        self._rebuilding()
+        return b'OK'
 
 
     def _save(self) -> bytes:
+        '''Сбрасывает журнал на диск и сворачивает его в снимок.'''
         try:
-            with open(f'{self._path}_tasks_queues.pickle', 'wb') as f1, open(f'{self._path}_tasks_in_processing.pickle', 'wb') as f2:
-                pickle.dump(self._tasks_queues, f1)
-                pickle.dump(self._tasks_in_processing, f2)
+            self._storage.flush()
+            self._journal.sync(force=True)
+            self._compact()
             return b'OK'
-        except:
+        except OSError:
             return b'SAVE ERROR'
 
 
-    def _loading(self) -> bool:
-        try:
-            with open(f'{self._path}_tasks_queues.pickle', 'rb') as f1, open(f'{self._path}_tasks_in_processing.pickle', 'rb') as f2:
-                self._tasks_queues = pickle.load(f1)
-                self._tasks_in_processing = pickle.load(f2)
-                self._deleting_saves()
-            return True
-        except:
+    def _compact(self) -> None:
+        '''Начинает новый сегмент журнала и записывает снимок состояния на момент его начала.
+           Где есть fork, снимок пишет дочерний процесс, и сервер не останавливается на сериализацию.
+           Старые сегменты удаляются только после успешной записи снимка.'''
+        if self._compacting and not self._compacted():
+            return
+
+        segment = self._journal.rotate()
+        state = (segment, self._tasks_in_processing, self._tasks_ids, self._tasks_index)
+        if not hasattr(os, 'fork'):
+            self._write_snapshot(state)
+            self._journal.remove_before(segment)
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                # Дочерний процесс не должен держать сокеты сервера и клиентов: иначе клиенты не получают
+                # закрытия соединения, а порт остается занятым, пока пишется снимок.
+                os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+                self._write_snapshot(state)
+                status = 0
+            finally:
+                os._exit(status)
+        self._compacting = (pid, segment)
+
+
+    def _compacted(self, wait: bool=False) -> bool:
+        '''Проверяет, закончил ли дочерний процесс запись снимка, и удаляет ставшие ненужными сегменты.
+           С wait дожидается его завершения.'''
+        pid, segment = self._compacting
+        finished_pid, status = os.waitpid(pid, 0 if wait else os.WNOHANG)
+        if not finished_pid:
             return False
 
+        self._compacting = None
+        if os.waitstatus_to_exitcode(status) == 0:
+            self._journal.remove_before(segment)
+        return True
+
+
+    def _write_snapshot(self, state: tuple) -> None:
+        with open(f'{self._path}_snapshot.tmp', 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{self._path}_snapshot.tmp', f'{self._path}_snapshot.pickle')
+
+
+    def _persisting(self) -> None:
+        '''Вызывается после каждой порции команд, до отправки ответов клиентам.'''
+        if self._fsync_batch:
+            self._storage.flush()
+        self._journal.sync()
+        if not self._fsync_batch or not self._journal.unsynced:
+            self._storage.remove_released()
+        if self._compacting:
+            self._compacted()
+        if self._journal.size >= self._compaction_size:
+            self._compact()
+
+
+    def _loading(self) -> bool:
+        '''Загружает последний снимок и повторяет записи журнала, сделанные после него.
+           Возвращает True, если было что восстанавливать.'''
+        segment = 0
+        if os.path.exists(f'{self._path}_snapshot.pickle'):
+            with open(f'{self._path}_snapshot.pickle', 'rb') as f:
+                segment, self._tasks_in_processing, self._tasks_ids, self._tasks_index = pickle.load(f)
+
+        segments = [journal_segment for journal_segment in self._journal.segments() if segment <= journal_segment < self._journal.segment]
+        for journal_segment in segments:
+            for record in self._journal.read(journal_segment):
+                self._replaying(*record)
 
-    def _deleting_saves(self) -> None:
-        os.remove(f'{self._path}_tasks_queues.pickle')
-        os.remove(f'{self._path}_tasks_in_processing.pickle')
+        self._rebuilding()
+        return bool(segments) or segment > 0
+
+
+    def _rebuilding(self) -> None:
+        '''Строит очереди готовых заданий и кучу сроков по всем заданиям и срокам их обработки,
+           загруженным с диска или полученным от ведущего сервера.'''
+        # Отложенные задания определяются по времени выдачи, записанному в самом задании.
+        now = time.time()
+        self._tasks_delayed = {queue: {id: task.due for id, task in tasks.items() if task.due > now}
+                               for queue, tasks in self._tasks_index.items()}
+        self._tasks_queues = {queue: sorted(task.key for id, task in tasks.items()
+                                            if (queue, id) not in self._tasks_in_processing and id not in self._tasks_delayed[queue])
+                              for queue, tasks in self._tasks_index.items()}
+        self._deadlines = [(deadline, queue, id) for (queue, id), deadline in self._tasks_in_processing.items()]
+        self._deadlines += [(due, queue, id) for queue, tasks in self._tasks_delayed.items() for id, due in tasks.items()]
+        heapq.heapify(self._deadlines)
+
+
+    def _replaying(self, operation: bytes, *args) -> None:
+        if operation == b'ADD':
+            queue, id, length, data, *options = args
+            self._tasks_index.setdefault(queue, {})[id] = Task(queue, length, data, id, *options)
+            self._tasks_ids[queue] = id + 1
+        elif operation == b'GET':
+            queue, id, deadline = args
+            self._tasks_in_processing[(queue, id)] = deadline
+            self._tasks_index[queue][id].deliveries += 1
+        elif operation == b'TOUCH':
+            queue, id, deadline = args
+            self._tasks_in_processing[(queue, id)] = deadline
+        elif operation == b'EXPIRE':
+            del self._tasks_in_processing[args]
+        elif operation == b'ACK':
+            queue, id = args
+            del self._tasks_in_processing[(queue, id)]
+            del self._tasks_index[queue][id]
+        elif operation == b'MOVE':
+            queue, id, target, target_id = args
+            self._tasks_in_processing.pop((queue, id), None)
+            self._relocate(queue, id, target, target_id)
+            self._tasks_ids[target] = target_id + 1
+        elif operation == b'SNAPSHOT':
+            # Полное состояние, которое ведущий сервер присылает резервному при подключении.
+            self._tasks_in_processing, self._tasks_ids, self._tasks_index = args
 
 
     def _checking_save(self) -> None:
-        if os.path.exists(f'{self._path}_tasks_queues.pickle'):
-            if not self._loading():
-                print('Сохраненные ранее данные не удалось загрузить, состояние очереди инициировано вновь.')
-                self._deleting_saves()
-            else:
+        self._journal = Journal(self._path, self._fsync_batch)
+        self._storage = PayloadStorage(self._path)
+        try:
+            loaded = self._loading()
+            self._storage.restore(task.data for tasks in self._tasks_index.values() for task in tasks.values()
+                                  if isinstance(task.data, StoredPayload))
+            if loaded:
                 print('Имеются ранее сохраненные данные, состояние очереди успешно загружено с диска.')
+                self._compact()
+        except Exception:
+            print('Сохраненные ранее данные не удалось загрузить, состояние очереди инициировано вновь.')
+            self._tasks_queues, self._tasks_in_processing, self._tasks_ids, self._tasks_index = {}, {}, {}, {}
+            self._tasks_delayed, self._deadlines = {}, []
+            self._setting_aside()
+            self._storage.restore(())
+
 
+    def _setting_aside(self) -> None:
+        '''Откладывает не загрузившиеся снимок, сегменты журнала и хранилища в файлы с суффиксом .broken.<время>.
+           Иначе следующий запуск снова споткнется о них и потеряет записи, сделанные после сброса состояния.'''
+        suffix = f'.broken.{int(time.time())}'
+        if os.path.exists(f'{self._path}_snapshot.pickle'):
+            os.replace(f'{self._path}_snapshot.pickle', f'{self._path}_snapshot.pickle{suffix}')
+        self._journal.set_aside_before(self._journal.segment, suffix)
+        self._storage.set_aside(suffix)
+        print(f'Поврежденные данные сохранены в файлы с суффиксом {suffix}.')
 
-    def _command_routing(self, command_data: bytes) -> bytes:
-        functions = {b'ADD': self._add_task, b'GET': self._get_task, b'ACK': self._ack_task, b'IN': self._in_task, b'SAVE': self._save}
-        command, *data = command_data.split(b' ')
+
+    def _command_routing(self, command_data: bytes, payload: bytearray=None) -> bytes:
+        '''Выполняет команду. Содержимое задания, прочитанное отдельно от заголовка команды,
+           передается в payload и становится последним аргументом команды.'''
+        functions = {b'ADD': self._add_task, b'GET': self._get_task, b'ACK': self._ack_task, b'IN': self._in_task, b'SAVE': self._save,
+                     b'MADD': self._add_tasks, b'MGET': self._get_tasks, b'STATS': self._stats, b'METRICS': self._metrics_text,
+                     b'REPLAY': self._replay_dead_tasks, b'PROMOTE': self._promote,
+                     b'TOUCH': self._touch_task}
+        if self._leader is not None:
+            # Резервный сервер только применяет журнал ведущего, пока его не сделают ведущим.
+            return self._promote() if command_data == b'PROMOTE' else b'STANDBY'
+        command, *data = command_data.split(b' ', 3)
+        if payload is not None:
+            data.append(payload)
+        self._expire_tasks()
 
         if command not in functions:
             return b'ERROR'
-        elif len(data) > 2:
-            return functions[command](data[0], data[1], b' '.join(data[2:]))
-        elif len(data) == 2:
-            return functions[command](data[0], data[1])
-        elif len(data) == 1:
-            return functions[command](data[0])
-        else:
-            return functions[command]()
+        start = time.perf_counter()
+        try:
+            if len(data) > 2:
+                return functions[command](data[0], data[1], data[2])
+            elif len(data) == 2:
+                return functions[command](data[0], data[1])
+            elif len(data) == 1:
+                return functions[command](data[0])
+            else:
+                return functions[command]()
+        except (TypeError, ValueError):
+            return b'ERROR'
+        finally:
+            self._metrics.observe(command, time.perf_counter() - start)
+
+
+    def _stopping(self) -> None:
+        '''Дожидается записи снимка при остановке сервера, чтобы дочерний процесс не пережил его.'''
+        if self._compacting:
+            self._compacted(wait=True)
 
 
     def run(self):
         self._checking_save()
         self._server.listen(1)
+        # По SIGTERM сервер завершается штатно, дождавшись записи снимка.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            while True:
+                connection, client_address = self._server.accept()
+                response = self._command_routing(*self._receiving(connection))
+                self._persisting()
+                connection.sendall(response)
+                connection.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopping()
+
+
+    def _receiving(self, connection: socket.socket) -> tuple[bytes, bytearray | None]:
+        '''Читает команду соединения, возвращает заголовок команды и отдельно содержимое задания ADD.
+           Содержимое читается ровно по указанной длине через recv_into в буфер, который растет удвоением
+           по мере прихода данных, а не выделяется сразу по длине из заголовка. Поэтому содержимое
+           может приходить любым числом сегментов и быть любого размера. Приоритет и задержка
+           после содержимого дочитываются отдельно, заголовок команды должен прийти при первом чтении.'''
+        data = connection.recv(self.RECEIVE_SIZE)
+        if data.startswith(b'MADD '):
+            return self._receiving_batch(connection, data), None
+        command = data.split(b' ', 3)
+        if command[0] != b'ADD' or len(command) < 4 or not command[2].isdigit():
+            return data.rstrip(b'\r\n'), None
+
+        length = int(command[2])
+        payload = bytearray(min(length, max(len(command[3]), self.RECEIVE_SIZE)))
+        received = min(len(command[3]), length)
+        payload[:received] = command[3][:received]
+        while received < length:
+            if received == len(payload):
+                payload += bytes(min(len(payload), length - len(payload)))
+            with memoryview(payload) as view:
+                size = connection.recv_into(view[received:])
+            if not size:
+                break
+            received += size
+
+        del payload[received:]
+        if received == length:
+            payload += self._receiving_tail(connection, command[3][length:], len(command[3]) < length)
+        return b' '.join(command[:3]), payload
+
+
+    def _receiving_batch(self, connection: socket.socket, data: bytes) -> bytes:
+        '''Читает команду MADD целиком: пока известные длины заданий говорят, что содержимое еще не получено,
+           данные дочитываются без ограничения времени, а недописанные длины и остаток после содержимого
+           ждутся так же, как остаток команды ADD.'''
+        parser = CommandParser()
+        commands = parser.feed(data)
+        split = False
+        while not commands:
+            end = parser.payloads_end()
+            if end is not None and len(parser) < end:
+                more = connection.recv(self.RECEIVE_SIZE)
+                split = True
+            elif end is None or split:
+                more = self._receiving_within(connection)
+            else:
+                more = b''
+            if not more:
+                return parser.pending
+            commands = parser.feed(more)
+        return commands[0]
+
+
+    def _receiving_tail(self, connection: socket.socket, tail: bytes, split: bool) -> bytes:
+        '''Дочитывает то, что идет после содержимого заданий: приоритет и задержку до перевода строки или конца данных.
+           Если содержимое пришло не целиком при первом чтении (split), остаток команды мог еще не прийти,
+           поэтому его продолжение ждется TAIL_WAIT секунд после каждой порции.'''
+        if split:
+            if not tail:
+                tail = self._receiving_within(connection)
+            while tail and b'\n' not in tail and len(tail) < self.RECEIVE_SIZE and (more := self._receiving_within(connection)):
+                tail += more
+        return tail.split(b'\n', 1)[0].rstrip(b'\r')
+
+
+    def _receiving_within(self, connection: socket.socket) -> bytes:
+        connection.settimeout(self.TAIL_WAIT)
+        try:
+            return connection.recv(self.RECEIVE_SIZE)
+        except socket.timeout:
+            return b''
+        finally:
+            connection.settimeout(None)
+
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Обслуживает соединение клиента, пока тот его не закроет. Клиент может отправлять
+           команды не дожидаясь ответов, ответы возвращаются в порядке команд через перевод строки.
+           После команды FRAMED каждый ответ, включая ответ на нее, предваряется своей длиной: <length> <response>.
+           Соединение, которое начинается с команды двоичного протокола, обслуживается по двоичному протоколу.'''
+        parser = CommandParser()
+        framed = False
+        try:
+            data = await reader.read(65536)
+            if BinaryParser.detect(data):
+                await self._handle_binary(reader, writer, data)
+                return
+            if self._replication and data == b'REPLICATE\n':
+                await self._serving_replica(reader, writer)
+                return
+            disconnected = lambda: reader.at_eof() or writer.is_closing()
+            while data:
+                # Команды пакета выполняются без переключений на другие соединения, ждущие GET получат эту проверку.
+                self._disconnected = disconnected
+                logged = self._logged
+                responses = []
+                for command_data in parser.feed(data):
+                    framed = framed or command_data == b'FRAMED'
+                    responses.append(b'OK' if command_data == b'FRAMED' else self._command_routing(command_data))
+                self._persisting()
+                if self._replicas and self._logged != logged:
+                    await self._replicating()
+                # Ответы пакета отправляются одной записью, иначе мелкие сегменты ждут подтверждений TCP.
+                output = []
+                for response in responses:
+                    if isinstance(response, asyncio.Future):
+                        writer.writelines(output)
+                        output.clear()
+                        response = await response
+                    if framed:
+                        output.append(str(len(response)).encode('utf-8') + b' ')
+                    output += [response, b'\n']
+                writer.writelines(output)
+                await writer.drain()
+                data = await reader.read(65536)
+        except (ConnectionError, asyncio.CancelledError):
+            pass # Отмена приходит при остановке по SIGTERM, соединение просто закрывается.
+        finally:
+            writer.close()
+
+
+    async def _handle_binary(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes) -> None:
+        '''Обслуживает соединение двоичного протокола. Заголовок и содержимое ответа передаются в запись отдельными частями,
+           содержимое из хранилища отправляется прямо из отображения сегмента.'''
+        parser = BinaryParser()
+        disconnected = lambda: reader.at_eof() or writer.is_closing()
+        while data:
+            self._disconnected = disconnected
+            logged = self._logged
+            responses = [self._binary_routing(command) for command in parser.feed(data)]
+            self._persisting()
+            if self._replicas and self._logged != logged:
+                await self._replicating()
+            output = []
+            for response in responses:
+                if isinstance(response, asyncio.Future):
+                    writer.writelines(output)
+                    output.clear()
+                    response = await response
+                output += response
+            writer.writelines(output)
+            await writer.drain()
+            data = await reader.read(65536)
+
+
+    def _binary_routing(self, command: BinaryCommand) -> list[bytes | memoryview] | asyncio.Future:
+        '''Выполняет команду двоичного протокола теми же методами, что и текстовые команды, но без разбора и форматирования текста.'''
+        if self._leader is not None or not command.name:
+            return BinaryParser.response(BinaryParser.ERROR)
+        self._expire_tasks()
+        start = time.perf_counter()
+        try:
+            if command.name == b'ADD':
+                length = str(len(command.payload)).encode('utf-8')
+                # Хранилище копирует содержимое в сегмент само, в памяти задание хранит свою копию.
+                payload = command.payload if self._mmap_storage else bytes(command.payload)
+                id = self._enqueue(command.queue, length, payload, command.priority, command.argument / 1000)
+                return BinaryParser.response(BinaryParser.OK, id)
+            if command.name == b'GET':
+                task = self._take_task(command.queue)
+                if task is None and command.argument and self._loop:
+                    return self._waiting(command.queue, command.argument / 1000, self._binary_task_response)
+                return self._binary_task_response(task)
+            if command.name == b'TOUCH':
+                if len(command.payload) != BinaryParser.TASK_ID.size:
+                    return BinaryParser.response(BinaryParser.ERROR)
+                id, = BinaryParser.TASK_ID.unpack(command.payload)
+                found = self._touch_task(command.queue, id, command.argument / 1000 or None)
+                return BinaryParser.response(BinaryParser.OK if found == b'YES' else BinaryParser.NONE, id)
+            found = (self._ack_task if command.name == b'ACK' else self._in_task)(command.queue, command.argument)
+            return BinaryParser.response(BinaryParser.OK if found == b'YES' else BinaryParser.NONE, command.argument)
+        finally:
+            self._metrics.observe(command.name, time.perf_counter() - start)
+
+
+    def _binary_task_response(self, task: Task | None) -> list[bytes | memoryview]:
+        if task is None:
+            return BinaryParser.response(BinaryParser.NONE)
+        return BinaryParser.response(BinaryParser.OK, task.id, self._payload(task))
+
+
+    async def _expiring(self) -> None:
+        '''Возвращает в очередь просроченные задания, даже пока клиенты не присылают команд,
+           чтобы их сразу получили ждущие в блокирующем GET клиенты.'''
         while True:
-            connection, client_address = self._server.accept()
-            data = connection.recv(1000000)
-            connection.send(self._command_routing(data))
-            connection.close()
+            await asyncio.sleep(self.EXPIRING_INTERVAL)
+            if self._leader is None:
+                self._expire_tasks()
+            self._persisting()
+
+
+    async def _scraping(self) -> bytes:
+        return self._metrics_text()
+
+
+    async def serve(self, metrics_port: int=0) -> None:
+        self._checking_save()
+        self._loop = asyncio.get_running_loop()
+        self._server.listen(socket.SOMAXCONN)
+        server = await asyncio.start_server(self._handle_connection, sock=self._server)
+        expiring = asyncio.create_task(self._expiring())
+        if self._leader is not None:
+            self._following = asyncio.create_task(self._following_leader())
+        if metrics_port:
+            await serve_metrics(self.address[0], metrics_port, self._scraping)
+        # По SIGTERM сервер завершается штатно, дождавшись записи снимка.
+        stopping = self._loop.create_future()
+        self._loop.add_signal_handler(signal.SIGTERM, stopping.set_result, None)
+        async with server:
+            await stopping
+
+
+    def run_async(self, metrics_port: int=0):
+        try:
+            asyncio.run(self.serve(metrics_port))
+        finally:
+            self._stopping()
+
+
+class ShardRouter:
+    '''Запускает несколько процессов-шардов TaskQueueServer, каждый владеет своей частью очередей
+       по хешу имени очереди и своей папкой сохранений. Принимает соединения клиентов и пересылает
+       каждую команду шарду ее очереди, ответы возвращаются клиенту в порядке команд.'''
+    def __init__(self, ip: str, port: int, path: str, shards: int, **server_kwargs):
+        self._ip = ip
+        self._port = port # Сокет открывается после запуска шардов, чтобы их процессы его не унаследовали.
+
+        self._paths = [os.path.join(path, f'shard_{shard}', '') for shard in range(shards)]
+        self._server_kwargs = server_kwargs
+        self._processes = [] # Процессы шардов.
+        self._addresses = [] # Адреса, на которых шарды принимают соединения роутера.
+
+
+    def _shard(self, command_data: bytes) -> int | None:
+        '''Возвращает номер шарда, которому принадлежит очередь команды, None для команд без очереди.
+           Очередь <queue>.dlq живет на шарде очереди <queue>, туда ее задания переносит шард.'''
+        command = command_data.split(b' ', 2)
+        if len(command) < 2:
+            return None
+        return self._queue_shard(command[1])
+
+
+    def _queue_shard(self, queue: bytes) -> int:
+        return zlib.crc32(queue.removesuffix(TaskQueueServer.DEAD_LETTER_SUFFIX)) % len(self._paths)
+
+
+    def _starting_shards(self) -> None:
+        addresses = multiprocessing.Queue()
+        for shard, path in enumerate(self._paths):
+            os.makedirs(path, exist_ok=True)
+            process = multiprocessing.Process(target=serve_shard, args=(shard, addresses, path), kwargs=self._server_kwargs, daemon=True)
+            process.start()
+            self._processes.append(process)
+
+        shard_addresses = dict(addresses.get() for _ in self._paths)
+        self._addresses = [shard_addresses[shard] for shard in range(len(self._paths))]
+
+
+    def _stopping_shards(self) -> None:
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            process.join()
+
+
+    async def _connecting(self, shard: int) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        reader, writer = await asyncio.open_connection(*self._addresses[shard])
+        writer.write(b'FRAMED\n')
+        await self._reading_response(reader)
+        return reader, writer
+
+
+    async def _reading_response(self, reader: asyncio.StreamReader) -> bytes:
+        length = int(await reader.readuntil(b' '))
+        return (await reader.readexactly(length + 1))[:-1]
+
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Пересылает команды клиента шардам, не дожидаясь ответов, поэтому шарды выполняют их параллельно.
+           Для каждого соединения клиента открывается свое соединение с каждым нужным шардом.'''
+        parser = CommandParser()
+        shards = {}
+        framed = False
+        try:
+            data = await reader.read(65536)
+            if BinaryParser.detect(data):
+                await self._handle_binary(reader, writer, data, shards)
+                return
+            while data:
+                pending = []
+                forwarded = {} # Команды пакета для каждого шарда, отправляются одной записью.
+                for command_data in parser.feed(data):
+                    if command_data == b'FRAMED':
+                        framed = True
+                        pending.append(())
+                        continue
+                    shard = self._shard(command_data)
+                    targets = range(len(self._paths)) if shard is None else (shard, )
+                    for target in targets:
+                        forwarded.setdefault(target, []).append(command_data + b'\n')
+                    pending.append(targets)
+
+                for target, commands in forwarded.items():
+                    if target not in shards:
+                        shards[target] = await self._connecting(target)
+                    shards[target][1].writelines(commands)
+
+                output = []
+                for targets in pending:
+                    responses = [await self._reading_response(shards[target][0]) for target in targets] or [b'OK']
+                    response = self._merging(responses)
+                    if framed:
+                        output.append(str(len(response)).encode('utf-8') + b' ')
+                    output += [response, b'\n']
+                writer.writelines(output)
+                await writer.drain()
+                data = await reader.read(65536)
+        except (ConnectionError, asyncio.CancelledError):
+            pass # Отмена приходит при остановке по SIGTERM, соединение просто закрывается.
+        finally:
+            for _, shard_writer in shards.values():
+                shard_writer.close()
+            writer.close()
+
+
+    async def _handle_binary(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes, shards: dict) -> None:
+        '''Пересылает команды двоичного протокола шардам по двоичному протоколу, ответы шардов передаются клиенту как есть.'''
+        parser = BinaryParser()
+        while data:
+            pending = []
+            forwarded = {}
+            for command in parser.feed(data):
+                shard = self._queue_shard(command.queue) if command.name else None
+                if shard is not None:
+                    forwarded.setdefault(shard, []).extend(BinaryParser.pack(command))
+                pending.append(shard)
+
+            for shard, commands in forwarded.items():
+                if shard not in shards:
+                    shards[shard] = await asyncio.open_connection(*self._addresses[shard])
+                shards[shard][1].writelines(commands)
+
+            output = []
+            for shard in pending:
+                if shard is None:
+                    output += BinaryParser.response(BinaryParser.ERROR)
+                    continue
+                header = await shards[shard][0].readexactly(BinaryParser.RESPONSE.size)
+                output += [header, await shards[shard][0].readexactly(BinaryParser.RESPONSE.unpack(header)[2])]
+            writer.writelines(output)
+            await writer.drain()
+            data = await reader.read(65536)
+
+
+    def _merging(self, responses: list[bytes]) -> bytes:
+        '''Собирает ответ клиенту из ответов шардов. Команды без очереди выполняются на всех шардах:
+           статистика STATS суммируется, метрики METRICS объединяются с меткой шарда,
+           для остальных (SAVE) ответ общий, если он одинаков.'''
+        if len(responses) == 1:
+            return responses[0]
+        if responses[0].startswith(b'# HELP'):
+            return merge_metrics(responses)
+        if responses[0].startswith(b'depth '):
+            return merge_stats(responses)
+        return responses[0] if len(set(responses)) == 1 else b'ERROR'
+
+
+    async def _scraping(self) -> bytes:
+        responses = []
+        for shard in range(len(self._paths)):
+            reader, writer = await self._connecting(shard)
+            writer.write(b'METRICS\n')
+            responses.append(await self._reading_response(reader))
+            writer.close()
+        return merge_metrics(responses)
+
+
+    async def serve(self, metrics_port: int=0) -> None:
+        server = await asyncio.start_server(self._handle_connection, self._ip, self._port, reuse_address=True, backlog=socket.SOMAXCONN)
+        if metrics_port:
+            await serve_metrics(self._ip, metrics_port, self._scraping)
+        # По SIGTERM роутер завершается штатно, чтобы остановить и процессы шардов.
+        stopping = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set_result, None)
+        async with server:
+            await stopping
+
+
+    def run(self, metrics_port: int=0):
+        self._starting_shards()
+        try:
+            asyncio.run(self.serve(metrics_port))
+        finally:
+            self._stopping_shards()
+
+
+def merge_stats(responses: list[bytes]) -> bytes:
+    '''Суммирует статистику STATS нескольких шардов, время работы и отставание журнала берутся наибольшие.'''
+    stats = {}
+    for response in responses:
+        pairs = response.decode('utf-8').split(' ')
+        for name, value in zip(pairs[::2], pairs[1::2]):
+            value = float(value) if '.' in value else int(value)
+            if name in ('uptime', 'journal_sync_age'):
+                stats[name] = max(stats.get(name, 0), value)
+            else:
+                stats[name] = stats.get(name, 0) + value
+    return ' '.join(f'{name} {value:.3f}' if isinstance(value, float) else f'{name} {value}'
+                    for name, value in stats.items()).encode('utf-8')
+
+
+def merge_metrics(responses: list[bytes]) -> bytes:
+    '''Объединяет метрики нескольких шардов: к каждому значению добавляется метка shard,
+       описание метрики (# HELP и # TYPE) остается одно, значения всех шардов идут после него.'''
+    metrics = {} # Строки описания и строки значений по имени метрики в порядке первого появления.
+    for shard, response in enumerate(responses):
+        for line in response.decode('utf-8').split('\n'):
+            if line.startswith('#'):
+                name = line.split(' ', 3)[2]
+                header, _ = metrics.setdefault(name, ([], []))
+                if line not in header:
+                    header.append(line)
+                continue
+            sample, value = line.rsplit(' ', 1)
+            labels = f'shard="{shard}"'
+            sample = sample.replace('{', '{' + labels + ',', 1) if '{' in sample else sample + '{' + labels + '}'
+            metrics[name][1].append(f'{sample} {value}')
+    return '\n'.join(line for header, samples in metrics.values() for line in (*header, *samples)).encode('utf-8')
+
+
+def queue_label(queue: bytes, labels: str='') -> str:
+    '''Возвращает метки метрики Prometheus с именем очереди и дополнительными метками labels.'''
+    name = queue.decode('utf-8', 'replace').replace('\\', '\\\\').replace('"', '\\"')
+    return f'{{queue="{name}"{labels}}}'
+
+
+async def serve_metrics(ip: str, port: int, metrics: Callable[[], Awaitable[bytes]]) -> asyncio.Server:
+    '''Запускает HTTP сервер, отдающий на любой запрос метрики в текстовом формате Prometheus.'''
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = await metrics() + b'\n'
+            writer.writelines([b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n',
+                               f'Content-Length: {len(body)}\r\n\r\n'.encode('utf-8'), body])
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, ip, port, reuse_address=True)
+
+
+def serve_shard(shard: int, addresses: multiprocessing.Queue, path: str, **server_kwargs) -> None:
+    '''Запускает шард в отдельном процессе на свободном локальном порту и сообщает роутеру его адрес.'''
+    server = TaskQueueServer('127.0.0.1', 0, path, **server_kwargs)
+    addresses.put((shard, server.address))
+    server.run_async()
+
+
+def parse_queue_timeout(queue_timeout: str) -> tuple[bytes, float]:
+    queue, timeout = queue_timeout.rsplit('=', 1)
+    return queue.encode('utf-8'), float(timeout)
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
 
 
 def parse_args():
@@ -179,10 +1717,85 @@ def parse_args():
         type=int,
         default=5,
         help='Task maximum GET timeout in seconds')
+    parser.add_argument(
+        '-T',
+        action="append",
+        dest="queue_timeouts",
+        type=parse_queue_timeout,
+        default=[],
+        help='Task timeout of one queue as queue=seconds, can be repeated')
+    parser.add_argument(
+        '-a',
+        action="store_true",
+        dest="asynchronous",
+        help='Serve persistent connections with asyncio')
+    parser.add_argument(
+        '-f',
+        action="store",
+        dest="fsync_batch",
+        type=int,
+        default=1,
+        help='Journal records written between fsync calls, 0 leaves flushing to the OS')
+    parser.add_argument(
+        '-s',
+        action="store",
+        dest="compaction_size",
+        type=int,
+        default=64 * 2 ** 20,
+        help='Journal segment size in bytes that triggers compaction into a snapshot')
+    parser.add_argument(
+        '-m',
+        action="store_true",
+        dest="mmap_storage",
+        help='Keep task payloads in memory-mapped segment files instead of the heap')
+    parser.add_argument(
+        '-n',
+        action="store",
+        dest="shards",
+        type=int,
+        default=0,
+        help='Run this many shard processes, each owning a hash partition of queue names')
+    parser.add_argument(
+        '-e',
+        action="store",
+        dest="metrics_port",
+        type=int,
+        default=0,
+        help='Serve Prometheus metrics over HTTP on this port (asynchronous and sharded modes)')
+    parser.add_argument(
+        '-d',
+        action="store",
+        dest="max_deliveries",
+        type=int,
+        default=0,
+        help='Move a task to the <queue>.dlq queue after this many deliveries, 0 retries forever')
+    parser.add_argument(
+        '-F',
+        action="store",
+        dest="leader",
+        type=parse_address,
+        default=None,
+        help='Run as a hot standby of the asynchronous server at host:port until the PROMOTE command')
+    parser.add_argument(
+        '-R',
+        action="store_true",
+        dest="replication",
+        help='Accept hot standby servers started with -F (asynchronous mode)')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
-    args = parse_args()
-    server = TaskQueueServer(**args.__dict__)
-    server.run()
+    args = parse_args().__dict__
+    asynchronous = args.pop('asynchronous')
+    shards = args.pop('shards')
+    metrics_port = args.pop('metrics_port')
+    leader = args.pop('leader')
+    replication = args.pop('replication')
+    if shards:
+        ShardRouter(shards=shards, **args).run(metrics_port)
+    else:
+        server = TaskQueueServer(leader=leader, replication=replication, **args)
+        if asynchronous or leader:
+            server.run_async(metrics_port)
+        else:
+            server.run()
@@ -0,0 +1,39 @@
+import unittest
+import tempfile
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmark import Benchmark, LatencyStats, start_server
+
+
+class LatencyStatsTest(unittest.TestCase):
+    def test_percentiles(self):
+        stats = LatencyStats()
+        for latency in range(1000):
+            stats.record('ADD', latency / 1000)
+
+        self.assertEqual(1000, stats.count('ADD'))
+        self.assertEqual(0.5, stats.percentile('ADD', 0.5))
+        self.assertEqual(0.99, stats.percentile('ADD', 0.99))
+        self.assertEqual(0.999, stats.percentile('ADD', 0.999))
+        self.assertIn('ADD', stats.report(1))
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_short_run(self):
+        with tempfile.TemporaryDirectory() as path:
+            server = start_server(5599, path + os.sep, 1, ['-f', '0'])
+            try:
+                stats = Benchmark('127.0.0.1', 5599, 2, 2, 3, 10, 0.5, 0.5, 4).run()
+            finally:
+                server.terminate()
+                server.wait()
+
+        self.assertGreater(stats.count('ADD'), 0)
+        self.assertGreater(stats.count('GET'), 0)
+        self.assertIn('GET', stats.report(0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+import unittest
+import tempfile
+import asyncio
+import time
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from client import TaskQueueClient, AsyncTaskQueueClient, TaskQueueError
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.TemporaryDirectory()
+        self.server = subprocess.Popen(['python', 'task_queue/server.py', '-a', '-c', self.path.name + os.sep])
+        # Даем серверу время на запуск.
+        time.sleep(0.5)
+        self.client = TaskQueueClient(pool_size=2)
+
+
+    def tearDown(self):
+        self.client.close()
+        self.server.terminate()
+        self.server.wait()
+        self.path.cleanup()
+
+
+    def test_base_scenario(self):
+        task_id = self.client.add('1', b'12 45\n7')
+        self.assertTrue(self.client.check('1', task_id))
+        self.assertEqual((task_id, b'12 45\n7'), self.client.get('1'))
+        self.assertTrue(self.client.ack('1', task_id))
+        self.assertFalse(self.client.ack('1', task_id))
+        self.assertFalse(self.client.check('1', task_id))
+        self.assertIsNone(self.client.get('1'))
+        self.assertTrue(self.client.save())
+
+
+    def test_batches(self):
+        task_ids = self.client.add_many('1', [b'a', b'b c', b''])
+        self.assertEqual([True, True, True, False], self.client.check_many('1', task_ids + [b'100']))
+        self.assertEqual(list(zip(task_ids, [b'a', b'b c', b''])), self.client.get_many('1', 5))
+        self.assertEqual([], self.client.get_many('1', 5))
+        self.assertEqual([True, True, True], self.client.ack_many('1', task_ids))
+
+
+    def test_priorities(self):
+        low_id = self.client.add('1', b'low')
+        high_ids = self.client.add_many('1', [b'high 1', b'high 2'], priority=10)
+        urgent_id = self.client.add('1', b'urgent', priority=20)
+        self.assertEqual([(urgent_id, b'urgent'), (high_ids[0], b'high 1'), (high_ids[1], b'high 2'), (low_id, b'low')],
+                         self.client.get_many('1', 10))
+
+
+    def test_delay(self):
+        task_id = self.client.add('1', b'later', delay=0.3)
+        self.assertIsNone(self.client.get('1'))
+        self.assertEqual((task_id, b'later'), self.client.get('1', wait=1))
+
+
+    def test_touch(self):
+        task_id = self.client.add('1', b'long')
+        self.assertFalse(self.client.touch('1', task_id))
+        self.assertEqual((task_id, b'long'), self.client.get('1'))
+        self.assertTrue(self.client.touch('1', task_id, 60))
+        self.assertTrue(self.client.touch('1', task_id))
+
+
+    def test_errors(self):
+        # Ответ ERROR не возвращается как идентификатор задания.
+        with self.assertRaises(TaskQueueError):
+            self.client.add('1 2', b'x')
+        with self.assertRaises(TaskQueueError):
+            self.client.add_many('1', [b'x'], delay=-1)
+        with self.assertRaises(TaskQueueError):
+            self.client.get_many('1', 'x')
+        with self.assertRaises(TaskQueueError):
+            self.client.touch('1', 0, -1)
+        # Соединение после ошибки остается в пуле.
+        self.assertEqual(b'0', self.client.add('1', b'x'))
+        self.assertEqual(1, self.client._pool.qsize())
+
+
+    def test_threads(self):
+        with ThreadPoolExecutor(8) as executor:
+            task_ids = list(executor.map(lambda i: self.client.add('1', str(i).encode('utf-8')), range(200)))
+            tasks = list(executor.map(lambda _: self.client.get('1'), range(200)))
+        self.assertEqual(200, len(set(task_ids)))
+        self.assertEqual(sorted(task_ids), sorted(id for id, _ in tasks))
+        self.assertEqual(2, self.client._pool.qsize())
+
+
+    def test_async_client(self):
+        async def scenario():
+            client = AsyncTaskQueueClient(pool_size=2)
+            task_ids = await asyncio.gather(*[client.add('1', b'x\ny') for _ in range(50)])
+            self.assertEqual(50, len(set(task_ids)))
+            self.assertEqual([True] * 50, await client.check_many('1', task_ids))
+            first_id = min(task_ids, key=int)
+            self.assertEqual((first_id, b'x\ny'), await client.get('1'))
+            self.assertTrue(await client.ack('1', first_id))
+            self.assertEqual(49, len(await client.get_many('1', 100)))
+            self.assertIsNone(await client.get('1', wait=0.2))
+            with self.assertRaises(TaskQueueError):
+                await client.add('1 2', b'x')
+            with self.assertRaises(TaskQueueError):
+                await client.get_many('1', 'x')
+            client.close()
+
+        asyncio.run(scenario())
+
+
+    def test_async_cancel(self):
+        async def scenario():
+            client = AsyncTaskQueueClient(pool_size=2)
+            for _ in range(2):
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(client.get('1', wait=5), 0.1)
+            # Прерванные соединения закрыты, и их места в пуле свободны.
+            self.assertEqual(b'0', await asyncio.wait_for(client.add('1', b'x'), 2))
+            self.assertEqual((b'0', b'x'), await client.get('1'))
+            client.close()
+
+        asyncio.run(scenario())
+
+
+if __name__ == '__main__':
+    unittest.main()
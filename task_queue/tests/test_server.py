@@ -1,14 +1,57 @@
 import subprocess
+import threading
 import unittest
+import tempfile
+import asyncio
 import socket
+import struct
 import time
 import sys
 import os
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import TaskQueueServer, CommandParser, PayloadStorage, ShardRouter, BinaryCommand, BinaryParser, serve_metrics, parse_queue_timeout
+
+# Каждый тест запускает сервер со своей папкой для журнала и снимков.
+TEMP_DIR = tempfile.TemporaryDirectory()
+
+
+def server_path(test):
+    path = os.path.join(TEMP_DIR.name, test.id()) + os.sep
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def binary_command(code, queue, priority=0, argument=0, payload=b''):
+    return struct.pack('>BBhQI', code, len(queue), priority, argument, len(payload)) + queue + payload
+
+
+def binary_responses(connection, count):
+    '''Читает count ответов двоичного протокола: (состояние, идентификатор, содержимое).'''
+    responses = connection.makefile('rb')
+    result = []
+    for _ in range(count):
+        status, id, size = struct.unpack('>B3xQI', responses.read(16))
+        result.append((status, id, responses.read(size)))
+    responses.close()
+    return result
+
+
+def binary_scenario(test):
+    '''Проверяет команды двоичного протокола на сервере, слушающем порт 5555.'''
+    connection = socket.create_connection(('127.0.0.1', 5555))
+    connection.sendall(binary_command(0x81, b'1', payload=b'a b\n') + binary_command(0x81, b'1', priority=5, payload=b'c')
+                       + binary_command(0x82, b'1') + binary_command(0x83, b'1', argument=1) + binary_command(0x84, b'1', argument=0)
+                       + binary_command(0x82, b'1') + binary_command(0x82, b'1') + binary_command(0x83, b'1', argument=1)
+                       + binary_command(0x99, b'1'))
+    test.assertEqual([(0, 0, b''), (0, 1, b''), (0, 1, b'c'), (0, 1, b''), (0, 0, b''), (0, 0, b'a b\n'), (1, 0, b''), (1, 1, b''),
+                      (2, 0, b'')], binary_responses(connection, 9))
+    connection.close()
+
 
 class ServerBaseTest(unittest.TestCase):
     def setUp(self):
-        self.server = subprocess.Popen(['python', 'task_queue\\server.py'])
+        self.server = subprocess.Popen(['python', 'task_queue/server.py', '-c', server_path(self)])
         # Даем серверу время на запуск.
         time.sleep(0.5)
 
@@ -68,7 +111,7 @@ class ServerBaseTest(unittest.TestCase):
 
 class ServerAdditionalTest(unittest.TestCase):
     def setUp(self):
-        self.server = subprocess.Popen(['python', 'task_queue\\server.py'])
+        self.server = subprocess.Popen(['python', 'task_queue/server.py', '-c', server_path(self)])
         # Даем серверу время на запуск.
         time.sleep(0.5)
 
@@ -133,5 +176,723 @@ class ServerAdditionalTest(unittest.TestCase):
         self.assertEqual(b'0 0 ', self.send(b'GET 0'))
 
 
+    def test_ids_not_reused(self):
+        task_id_1 = self.send(b'ADD queue_1 1 a')
+        self.assertEqual(task_id_1 + b' 1 a', self.send(b'GET queue_1'))
+        self.assertEqual(b'YES', self.send(b'ACK queue_1 ' + task_id_1))
+
+        task_id_2 = self.send(b'ADD queue_1 1 b')
+        self.assertNotEqual(task_id_1, task_id_2)
+        self.assertEqual(b'NO', self.send(b'IN queue_1 ' + task_id_1))
+        self.assertEqual(b'0', self.send(b'ADD queue_2 1 c'))
+
+
+    def test_large_split_payload(self):
+        data = bytes(range(256)) * 12000 + b' \n '
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.sendall(f'ADD 1 {len(data)} '.encode('utf-8') + data[:1000])
+        time.sleep(0.2)
+        s.sendall(data[1000:])
+        task_id = s.recv(1000)
+        s.close()
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.sendall(b'GET 1')
+        response = b''
+        while chunk := s.recv(1000000):
+            response += chunk
+        s.close()
+        self.assertEqual(task_id + f' {len(data)} '.encode('utf-8') + data, response)
+
+
+    def test_huge_declared_length(self):
+        # Буфер не выделяется по длине из заголовка, поэтому такая команда не роняет сервер.
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.sendall(b'ADD 1 99999999999999 abc')
+        s.shutdown(socket.SHUT_WR)
+        self.assertEqual(b'ERROR', s.recv(1000))
+        s.close()
+        self.assertEqual(b'0', self.send(b'ADD 1 1 x'))
+
+
+    def test_large_payload_options(self):
+        data = b'x' * 100000
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.sendall(b'ADD 1 100000 ' + data + b' 9 0.3')
+        task_id = s.recv(1000)
+        s.close()
+        self.assertEqual(b'NONE', self.send(b'GET 1'))
+        time.sleep(0.4)
+        self.send(b'ADD 1 1 y')
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.sendall(b'GET 1')
+        response = b''
+        while chunk := s.recv(1000000):
+            response += chunk
+        s.close()
+        self.assertEqual(task_id + b' 100000 ' + data, response)
+
+
+    def test_large_batch(self):
+        data = [bytes(range(256)) * 400, b'a\nb' * 30000]
+        command = b'MADD 1 2 ' + b' '.join(str(len(part)).encode('utf-8') + b' ' + part for part in data) + b' 3'
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.sendall(command[:1000])
+        time.sleep(0.2)
+        s.sendall(command[1000:])
+        self.assertEqual(b'0 1', s.recv(1000))
+        s.close()
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', 5555))
+        s.sendall(b'MGET 1 2')
+        response = b''
+        while chunk := s.recv(1000000):
+            response += chunk
+        s.close()
+        self.assertEqual(b'2 0 102400 ' + data[0] + b' 1 90000 ' + data[1], response)
+
+
+class ServerAsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.server = subprocess.Popen(['python', 'task_queue/server.py', '-a', '-c', server_path(self)])
+        # Даем серверу время на запуск.
+        time.sleep(0.5)
+        self.connection = socket.create_connection(('127.0.0.1', 5555))
+        self.responses = self.connection.makefile('rb')
+
+
+    def tearDown(self):
+        self.responses.close()
+        self.connection.close()
+        self.server.terminate()
+        self.server.wait()
+
+
+    def send(self, *commands):
+        self.connection.sendall(b''.join(command + b'\n' for command in commands))
+        return [self.responses.readline().rstrip(b'\n') for _ in commands]
+
+
+    def test_persistent_connection(self):
+        task_id, = self.send(b'ADD 1 5 12345')
+        self.assertEqual([b'YES'], self.send(b'IN 1 ' + task_id))
+        self.assertEqual([task_id + b' 5 12345'], self.send(b'GET 1'))
+        self.assertEqual([b'YES'], self.send(b'ACK 1 ' + task_id))
+        self.assertEqual([b'ERROR'], self.send(b'ADDD 1 5 12345'))
+
+
+    def test_pipelining(self):
+        task_ids = self.send(*[b'ADD 1 5 12345'] * 100)
+        self.assertEqual(100, len(set(task_ids)))
+        self.assertEqual([task_id + b' 5 12345' for task_id in task_ids], self.send(*[b'GET 1'] * 100))
+        self.assertEqual([b'YES'] * 100, self.send(*[b'ACK 1 ' + task_id for task_id in task_ids]))
+
+
+    def test_concurrent_clients(self):
+        other = socket.create_connection(('127.0.0.1', 5555))
+        other.sendall(b'ADD 2 3 abc\n')
+        task_id = other.recv(1000).rstrip(b'\n')
+        self.assertEqual([task_id + b' 3 abc'], self.send(b'GET 2'))
+        other.close()
+
+
+    def test_data_with_separators(self):
+        task_id, = self.send(b'ADD 1 7 a b\nc d')
+        self.connection.sendall(b'GET 1\n')
+        self.assertEqual(task_id + b' 7 a b\n', self.responses.readline())
+        self.assertEqual(b'c d\n', self.responses.readline())
+
+
+    def test_batch_commands(self):
+        task_ids, = self.send(b'MADD 1 3 1 a 3 b\nc 0 ')
+        task_ids = task_ids.split(b' ')
+        self.assertEqual(3, len(task_ids))
+        self.assertEqual([b'YES'], self.send(b'IN 1 ' + task_ids[2]))
+
+        self.connection.sendall(b'MGET 1 5\n')
+        self.assertEqual(b' '.join([b'3', task_ids[0], b'1 a', task_ids[1], b'3 b\n']), self.responses.readline())
+        self.assertEqual(b'c ' + task_ids[2] + b' 0 \n', self.responses.readline())
+        self.assertEqual([b'NONE'], self.send(b'MGET 1 5'))
+
+
+    def test_priorities(self):
+        self.assertEqual([b'0', b'1', b'2 3', b'4'], self.send(b'ADD 1 1 a 5', b'ADD 1 3 b 7 9', b'MADD 1 2 1 c 1 d 9', b'ADD 1 3 e f'))
+        self.assertEqual([b'1 3 b 7', b'2 1 c', b'3 1 d', b'0 1 a', b'4 3 e f'], self.send(*[b'GET 1'] * 5))
+        self.assertEqual([b'ERROR', b'ERROR', b'NONE'], self.send(b'ADD 1 1 ab', b'ADD 1 1 a x', b'GET 1'))
+
+
+    def test_blocking_get(self):
+        consumers = [socket.create_connection(('127.0.0.1', 5555)) for _ in range(2)]
+        for consumer in consumers:
+            consumer.sendall(b'GET 1 5\n')
+        time.sleep(0.2)
+
+        start = time.time()
+        task_id, = self.send(b'ADD 1 3 abc')
+        self.assertEqual(task_id + b' 3 abc\n', consumers[0].recv(1000))
+        self.assertLess(time.time() - start, 1)
+
+        consumers[1].settimeout(0.5)
+        with self.assertRaises(socket.timeout):
+            consumers[1].recv(1000)
+        consumers[1].settimeout(None)
+        task_id, = self.send(b'ADD 1 3 xyz')
+        self.assertEqual(task_id + b' 3 xyz\n', consumers[1].recv(1000))
+        for consumer in consumers:
+            consumer.close()
+
+
+    def test_blocking_get_disconnected(self):
+        consumer = socket.create_connection(('127.0.0.1', 5555))
+        consumer.sendall(b'GET 1 5\n')
+        time.sleep(0.2)
+        consumer.close()
+        time.sleep(0.1)
+
+        task_id, = self.send(b'ADD 1 3 abc')
+        self.assertEqual([task_id + b' 3 abc'], self.send(b'GET 1'))
+
+
+    def test_binary_protocol(self):
+        binary_scenario(self)
+        # Текстовые соединения обслуживаются по-прежнему.
+        self.assertEqual([b'2', b'YES', b'2 1 x'], self.send(b'ADD 1 1 x', b'IN 1 0', b'GET 1'))
+
+
+    def test_binary_blocking_get(self):
+        waiting = socket.create_connection(('127.0.0.1', 5555))
+        waiting.sendall(binary_command(0x82, b'1', argument=5000))
+        self.assertEqual([b'0'], self.send(b'ADD 1 3 a\nb 0 0.2'))
+        self.assertEqual([(0, 0, b'a\nb')], binary_responses(waiting, 1))
+        waiting.sendall(binary_command(0x82, b'1', argument=100))
+        self.assertEqual([(1, 0, b'')], binary_responses(waiting, 1))
+        waiting.close()
+
+
+    def test_blocking_get_delayed_task(self):
+        waiting = socket.create_connection(('127.0.0.1', 5555))
+        waiting.sendall(b'GET 1 5\n')
+        start = time.time()
+        self.assertEqual([b'0'], self.send(b'ADD 1 1 a 0 0.3'))
+        self.assertEqual(b'0 1 a\n', waiting.recv(1024))
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        waiting.close()
+
+
+    def test_blocking_get_timeout(self):
+        start = time.time()
+        self.assertEqual([b'NONE'], self.send(b'GET 1 0.5'))
+        self.assertGreater(time.time() - start, 0.4)
+        self.assertEqual([b'NONE'], self.send(b'GET 1'))
+
+
+class ServerShardTest(unittest.TestCase):
+    def setUp(self):
+        self.server = subprocess.Popen(['python', 'task_queue/server.py', '-n', '3', '-c', server_path(self)])
+        # Даем серверу время на запуск шардов.
+        time.sleep(1)
+        self.connection = socket.create_connection(('127.0.0.1', 5555))
+        self.responses = self.connection.makefile('rb')
+
+
+    def tearDown(self):
+        self.responses.close()
+        self.connection.close()
+        self.server.terminate()
+        self.server.wait()
+
+
+    def send(self, *commands):
+        self.connection.sendall(b''.join(command + b'\n' for command in commands))
+        return [self.responses.readline().rstrip(b'\n') for _ in commands]
+
+
+    def test_queues_partitioning(self):
+        queues = [f'queue_{i}'.encode('utf-8') for i in range(20)]
+        task_ids = self.send(*[b'ADD ' + queue + b' 3 a b' for queue in queues])
+        self.assertEqual([b'0'] * 20, task_ids)
+        self.assertEqual([b'0 3 a b'] * 20, self.send(*[b'GET ' + queue for queue in queues]))
+        self.assertEqual([b'YES'] * 20, self.send(*[b'ACK ' + queue + b' 0' for queue in queues]))
+        self.assertEqual([b'ERROR'], self.send(b'ADDD 1 5 12345'))
+        self.assertEqual(3, len(os.listdir(server_path(self))))
+
+
+    def test_save(self):
+        self.assertEqual([b'0', b'0', b'1'], self.send(b'ADD 1 1 a', b'ADD 2 1 b', b'ADD 1 1 c'))
+        self.assertEqual([b'OK'], self.send(b'SAVE'))
+
+        self.tearDown()
+        self.setUp()
+        self.assertEqual([b'0 1 a', b'0 1 b', b'1 1 c'], self.send(b'GET 1', b'GET 2', b'GET 1'))
+
+
+    def test_binary_protocol(self):
+        binary_scenario(self)
+
+
+    def test_dead_letter_queue_shard(self):
+        router = ShardRouter('127.0.0.1', 0, server_path(self), 3)
+        for queue in (b'1', b'queue_1', b'queue_2'):
+            self.assertEqual(router._shard(b'GET ' + queue), router._shard(b'GET ' + queue + b'.dlq'))
+
+
+    def test_stats(self):
+        queues = [f'queue_{i}'.encode('utf-8') for i in range(10)]
+        self.send(*[b'ADD ' + queue + b' 1 x' for queue in queues])
+        self.send(b'GET queue_0', b'GET queue_1', b'ACK queue_0 0')
+        stats = self.send(b'STATS')[0].split(b' ')
+        stats = dict(zip(stats[::2], stats[1::2]))
+        self.assertEqual((b'8', b'1', b'10', b'2', b'1', b'10'),
+                         (stats[b'depth'], stats[b'in_flight'], stats[b'added'], stats[b'got'], stats[b'acked'], stats[b'queues']))
+        self.assertEqual([b'depth 0 in_flight 1 delayed 0 added 1 got 1 acked 0 expired 0 dead 0'], self.send(b'STATS queue_1'))
+
+
+class ServerReplicationTest(unittest.TestCase):
+    def setUp(self):
+        # Ведущий хранит содержимое в сегментах, резервному оно передается само.
+        self.leader = subprocess.Popen(['python', 'task_queue/server.py', '-a', '-m', '-R',
+                                        '-c', server_path(self) + 'leader_'])
+        time.sleep(0.5)
+        self.standby = subprocess.Popen(['python', 'task_queue/server.py', '-p', '5556', '-F', '127.0.0.1:5555',
+                                         '-c', server_path(self) + 'standby_'])
+        time.sleep(0.5)
+
+
+    def tearDown(self):
+        for server in (self.leader, self.standby):
+            server.terminate()
+            server.wait()
+
+
+    def send(self, port, *commands):
+        connection = socket.create_connection(('127.0.0.1', port))
+        connection.sendall(b''.join(command + b'\n' for command in commands))
+        responses = connection.makefile('rb')
+        result = [responses.readline().rstrip(b'\n') for _ in commands]
+        responses.close()
+        connection.close()
+        return result
+
+
+    def test_failover(self):
+        self.assertEqual([b'0', b'1', b'2 3', b'0 1 a', b'YES'],
+                         self.send(5555, b'ADD 1 1 a', b'ADD 1 1 b', b'MADD 1 2 1 c 1 d', b'GET 1', b'ACK 1 0'))
+        self.assertEqual([b'1 1 b'], self.send(5555, b'GET 1'))
+        self.assertEqual([b'STANDBY'], self.send(5556, b'GET 1'))
+        # Ведущий сервер падает сразу после ответов: подтвержденные операции уже есть на резервном.
+        self.leader.kill()
+        self.leader.wait()
+
+        self.assertEqual([b'OK', b'NO', b'YES', b'2 1 c', b'4'],
+                         self.send(5556, b'PROMOTE', b'IN 1 0', b'IN 1 1', b'GET 1', b'ADD 1 1 e'))
+        self.assertEqual([b'YES', b'3 1 d'], self.send(5556, b'ACK 1 1', b'GET 1'))
+
+
+    def test_standby_restart(self):
+        self.send(5555, b'ADD 1 1 a', b'ADD 2 1 b')
+        self.standby.terminate()
+        self.standby.wait()
+        self.send(5555, b'ADD 1 1 c', b'GET 1')
+
+        self.standby = subprocess.Popen(['python', 'task_queue/server.py', '-p', '5556', '-F', '127.0.0.1:5555',
+                                         '-c', server_path(self) + 'standby_'])
+        time.sleep(0.5)
+        self.assertEqual([b'OK', b'1 1 c', b'0 1 b'], self.send(5556, b'PROMOTE', b'GET 1', b'GET 2'))
+
+
+    def test_leader_reconnect(self):
+        self.send(5555, b'ADD 1 1 a')
+        self.leader.terminate()
+        self.leader.wait()
+        # Ведущий без -R отвечает ERROR на REPLICATE, резервный не принимает это за запись и подключается заново.
+        self.leader = subprocess.Popen(['python', 'task_queue/server.py', '-a', '-c', server_path(self) + 'leader_'])
+        time.sleep(1)
+        self.leader.terminate()
+        self.leader.wait()
+        self.leader = subprocess.Popen(['python', 'task_queue/server.py', '-a', '-m', '-R',
+                                        '-c', server_path(self) + 'leader_'])
+        time.sleep(3)
+        self.assertEqual([b'1'], self.send(5555, b'ADD 1 1 b'))
+        self.leader.kill()
+        self.leader.wait()
+        self.assertEqual([b'OK', b'0 1 a', b'1 1 b'], self.send(5556, b'PROMOTE', b'GET 1', b'GET 1'))
+
+
+    def test_stalled_replica(self):
+        # Резервный сервер, который не подтверждает записи, отключается и не останавливает ведущего.
+        stalled = socket.create_connection(('127.0.0.1', 5555))
+        stalled.sendall(b'REPLICATE\n')
+        time.sleep(0.1)
+        started = time.time()
+        self.assertEqual([b'depth 0 in_flight 0 delayed 0 added 0 got 0 acked 0 expired 0 dead 0'], self.send(5555, b'STATS 1'))
+        self.assertLess(time.time() - started, 0.5)
+        self.assertEqual([b'0'], self.send(5555, b'ADD 1 1 a'))
+        self.assertLess(time.time() - started, 3)
+        self.assertEqual([b'1'], self.send(5555, b'ADD 1 1 b'))
+        self.assertLess(time.time() - started, 3)
+        stalled.settimeout(1)
+        while stalled.recv(65536):
+            pass
+        stalled.close()
+
+        self.leader.kill()
+        self.leader.wait()
+        self.assertEqual([b'OK', b'0 1 a', b'1 1 b'], self.send(5556, b'PROMOTE', b'GET 1', b'GET 1'))
+
+
+class ServerUnitTest(unittest.TestCase):
+    def setUp(self):
+        self.server = self.start_server()
+
+
+    def tearDown(self):
+        self.stop_server(self.server)
+
+
+    def start_server(self, **kwargs):
+        server = TaskQueueServer('127.0.0.1', 0, server_path(self), 1, **kwargs)
+        server._checking_save()
+        return server
+
+
+    def wait_compaction(self, server):
+        while server._compacting and not server._compacted():
+            time.sleep(0.01)
+
+
+    def payload_segments(self):
+        return len([name for name in os.listdir(server_path(self)) if name.startswith('_payloads.')])
+
+
+    def stop_server(self, server):
+        self.wait_compaction(server)
+        server._journal.close()
+        server._server.close()
+
+
+    def test_no_thread_per_task(self):
+        for _ in range(1000):
+            self.server._command_routing(b'ADD 1 1 x')
+            self.server._command_routing(b'GET 1')
+        self.assertEqual(1, threading.active_count())
+
+
+    def test_bulk_expiry(self):
+        task_ids = [self.server._command_routing(b'ADD 1 1 x') for _ in range(100)]
+        for _ in task_ids:
+            self.server._command_routing(b'GET 1')
+        self.assertEqual(b'YES', self.server._command_routing(b'ACK 1 ' + task_ids[0]))
+        self.assertEqual(b'NONE', self.server._command_routing(b'GET 1'))
+
+        time.sleep(1.1)
+        self.assertEqual(task_ids[1] + b' 1 x', self.server._command_routing(b'GET 1'))
+        self.assertEqual(98, len(self.server._tasks_queues[b'1']))
+        self.assertEqual(b'NO', self.server._command_routing(b'IN 1 ' + task_ids[0]))
+
+
+    def test_command_parser(self):
+        parser = CommandParser()
+        self.assertEqual([b'ADD q', b'GET 3 abc'], parser.feed(b'ADD q\nGET 3 abc\n'))
+        self.assertEqual([b'MADD q', b'ADD q 3 a\nb'], parser.feed(b'MADD q\nADD q 3 a\nb\n'))
+        self.assertEqual([], parser.feed(b'ADD q 3 a'))
+        self.assertEqual([b'ADD q 3 a\nb', b'GET q'], parser.feed(b'\nb\nGET q\n'))
+
+
+    def test_batch_commands(self):
+        task_ids = self.server._command_routing(b'MADD 1 3 5 12345 3 a b 1 c').split(b' ')
+        self.assertEqual([b'0', b'1', b'2'], task_ids)
+        self.assertEqual(b'2 0 5 12345 1 3 a b', self.server._command_routing(b'MGET 1 2'))
+        self.assertEqual(b'1 2 1 c', self.server._command_routing(b'MGET 1 2'))
+        self.assertEqual(b'NONE', self.server._command_routing(b'MGET 1 2'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'MADD 1 2 5 12345'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'MADD 1 1 9 12345'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'ADD 1 9 12345'))
+
+
+    def test_journal_replay(self):
+        task_ids = [self.server._command_routing(b'ADD 1 3 a b') for _ in range(3)]
+        self.server._command_routing(b'GET 1')
+        self.server._command_routing(b'GET 1')
+        self.server._command_routing(b'ACK 1 ' + task_ids[0])
+        self.server._persisting()
+        # Сервер падает без команды SAVE.
+        self.stop_server(self.server)
+
+        self.server = self.start_server()
+        self.assertEqual(b'NO', self.server._command_routing(b'IN 1 ' + task_ids[0]))
+        self.assertEqual(b'YES', self.server._command_routing(b'IN 1 ' + task_ids[1]))
+        self.assertEqual(task_ids[2] + b' 3 a b', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'3', self.server._command_routing(b'ADD 1 1 c'))
+        time.sleep(1.1)
+        self.assertEqual(task_ids[1] + b' 3 a b', self.server._command_routing(b'GET 1'))
+
+
+    def test_broken_snapshot(self):
+        self.server._command_routing(b'ADD 1 1 x')
+        self.server._persisting()
+        self.server._save()
+        self.stop_server(self.server)
+        with open(server_path(self) + '_snapshot.pickle', 'wb') as f:
+            f.write(b'garbage')
+
+        self.server = self.start_server()
+        self.assertEqual(b'NONE', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'0', self.server._command_routing(b'ADD 2 1 y'))
+        self.server._persisting()
+        self.stop_server(self.server)
+        # Поврежденный снимок отложен и не мешает загрузить записи, сделанные после сброса состояния.
+        self.server = self.start_server()
+        self.assertEqual(b'0 1 y', self.server._command_routing(b'GET 2'))
+        self.assertTrue(any(name.startswith('_snapshot.pickle.broken.') for name in os.listdir(server_path(self))))
+
+
+    def test_snapshot_child_closes_sockets(self):
+        listening = self.server._server.fileno()
+        write_snapshot = self.server._write_snapshot
+
+        def checking(state):
+            # Снимок пишется, только если дочерний процесс не держит сокет сервера.
+            try:
+                os.fstat(listening)
+            except OSError:
+                write_snapshot(state)
+
+        self.server._write_snapshot = checking
+        self.server._command_routing(b'ADD 1 1 x')
+        self.server._save()
+        self.wait_compaction(self.server)
+        self.assertTrue(os.path.exists(server_path(self) + '_snapshot.pickle'))
+
+
+    def test_compaction(self):
+        self.stop_server(self.server)
+        self.server = self.start_server(compaction_size=1000)
+        for _ in range(100):
+            self.server._command_routing(b'ADD 1 5 12345')
+            self.server._persisting()
+        self.wait_compaction(self.server)
+        self.assertEqual(b'OK', self.server._command_routing(b'SAVE'))
+        self.wait_compaction(self.server)
+        self.assertEqual([self.server._journal.segment], self.server._journal.segments())
+        self.stop_server(self.server)
+
+        self.server = self.start_server()
+        self.assertEqual(b'0 5 12345', self.server._command_routing(b'GET 1'))
+        self.assertEqual(99, len(self.server._tasks_queues[b'1']))
+
+
+    def test_priorities(self):
+        self.stop_server(self.server)
+        self.server = self.start_server(compaction_size=300)
+        for priority in (0, 5, 0, 5, -1):
+            self.server._command_routing(f'ADD 1 1 x {priority}'.encode('utf-8'))
+            self.server._persisting()
+        self.assertEqual(b'1 1 x', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'3 1 x', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'5', self.server._command_routing(b'ADD 1 1 y 9'))
+        self.server._persisting()
+        self.wait_compaction(self.server)
+        # После перезапуска приоритеты восстанавливаются и из снимка, и из журнала.
+        self.stop_server(self.server)
+
+        self.server = self.start_server()
+        self.assertEqual(b'5 1 y', self.server._command_routing(b'GET 1'))
+        time.sleep(1.1)
+        self.assertEqual(b'6 5 1 y 1 1 x 3 1 x 0 1 x 2 1 x 4 1 x', self.server._command_routing(b'MGET 1 10'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'MADD 1 1 1 x y'))
+
+
+    def test_delayed_tasks(self):
+        self.assertEqual(b'0', self.server._command_routing(b'ADD 1 1 a 0 0.3'))
+        self.assertEqual(b'1 2', self.server._command_routing(b'MADD 1 2 1 b 1 c 5 0.6'))
+        self.assertEqual(b'3', self.server._command_routing(b'ADD 1 1 d'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'ADD 1 1 e 0 -1'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'ADD 1 1 e 0 nan'))
+        self.assertEqual(b'3 1 d', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'NONE', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'NO', self.server._command_routing(b'ACK 1 0'))
+        self.assertEqual(b'YES', self.server._command_routing(b'IN 1 0'))
+        self.assertTrue(self.server._command_routing(b'STATS 1').startswith(b'depth 0 in_flight 1 delayed 3 '))
+        self.server._persisting()
+        # Отложенные задания переживают перезапуск.
+        self.stop_server(self.server)
+
+        self.server = self.start_server()
+        time.sleep(0.35)
+        self.assertEqual(b'0 1 a', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'NONE', self.server._command_routing(b'GET 1'))
+        time.sleep(0.3)
+        self.assertEqual(b'2 1 1 b 2 1 c', self.server._command_routing(b'MGET 1 5'))
+
+
+    def test_dead_letter_queue(self):
+        self.stop_server(self.server)
+        self.server = self.start_server(max_deliveries=2)
+        self.assertEqual(b'0', self.server._command_routing(b'ADD 1 1 x 3'))
+        for _ in range(2):
+            self.assertEqual(b'0 1 x', self.server._command_routing(b'GET 1'))
+            time.sleep(1.1)
+            self.server._expire_tasks()
+        self.assertEqual(b'NONE', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'NO', self.server._command_routing(b'IN 1 0'))
+        self.assertEqual(b'YES', self.server._command_routing(b'IN 1.dlq 0'))
+        self.assertTrue(self.server._command_routing(b'STATS 1').endswith(b' expired 2 dead 1'))
+        self.server._persisting()
+        self.stop_server(self.server)
+
+        self.server = self.start_server(max_deliveries=2)
+        self.assertEqual(b'1', self.server._command_routing(b'REPLAY 1'))
+        self.assertEqual(b'0', self.server._command_routing(b'REPLAY 1'))
+        self.assertEqual(b'1 1 x', self.server._command_routing(b'GET 1'))
+        # Счетчик выдач вернувшегося задания начинается заново.
+        time.sleep(1.1)
+        self.assertEqual(b'1 1 x', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'YES', self.server._command_routing(b'ACK 1 1'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'REPLAY 1 -1'))
+
+
+    def test_touch(self):
+        self.server._command_routing(b'ADD 1 1 x')
+        self.server._command_routing(b'ADD 1 1 y')
+        self.assertEqual(b'NO', self.server._command_routing(b'TOUCH 1 0'))
+        self.assertEqual(b'0 1 x', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'1 1 y', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'YES', self.server._command_routing(b'TOUCH 1 0 2.5'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'TOUCH 1 1 0'))
+        self.assertEqual(b'ERROR', self.server._command_routing(b'TOUCH 1 1 inf'))
+        self.assertEqual(b'NO', self.server._command_routing(b'TOUCH 2 0'))
+        self.server._persisting()
+        # Продленный срок переживает перезапуск.
+        self.stop_server(self.server)
+
+        self.server = self.start_server()
+        time.sleep(1.1)
+        self.assertEqual(b'1 1 y', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'NONE', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'YES', self.server._command_routing(b'TOUCH 1 1'))
+        self.assertEqual(b'YES', self.server._command_routing(b'ACK 1 0'))
+        self.assertEqual(b'NO', self.server._command_routing(b'TOUCH 1 0'))
+        touch = BinaryCommand(b'TOUCH', b'1', 0, 1500, struct.pack('>Q', 1))
+        self.assertEqual(BinaryParser.response(BinaryParser.OK, 1), self.server._binary_routing(touch))
+        self.assertAlmostEqual(time.time() + 1.5, self.server._tasks_in_processing[(b'1', 1)], delta=0.1)
+        self.assertEqual(BinaryParser.response(BinaryParser.NONE, 0),
+                         self.server._binary_routing(touch._replace(payload=struct.pack('>Q', 0))))
+        self.assertEqual(BinaryParser.response(BinaryParser.ERROR), self.server._binary_routing(touch._replace(payload=b'1')))
+
+
+    def test_binary_parser(self):
+        parser = BinaryParser()
+        data = binary_command(0x81, b'1', 3, 0, b'a' * 100000) + binary_command(0x81, b'queue_2', 0, 0, b'b' * 10)
+        data += binary_command(0x82, b'1', 0, 5000)
+        self.assertEqual([], parser.feed(data[:50000]))
+        first, second = parser.feed(data[50000:-5])
+        self.assertEqual((b'ADD', b'1', 3, 0, b'a' * 100000), first)
+        self.assertEqual((b'ADD', b'queue_2', 0, 0, b'b' * 10), second)
+        # Содержимое - срезы одного буфера, а не копии.
+        self.assertIs(first.payload.obj, second.payload.obj)
+        self.assertEqual([(b'GET', b'1', 0, 5000, b'')], parser.feed(data[-5:]))
+        # Содержимое в памяти задание хранит в своей копии, а не в буфере соединения.
+        self.server._binary_routing(first)
+        self.assertEqual(b'0 100000 ' + b'a' * 100000, self.server._command_routing(b'GET 1'))
+        self.assertIsInstance(self.server._tasks_index[b'1'][0].data, bytes)
+
+
+    def test_queue_timeouts(self):
+        self.stop_server(self.server)
+        self.server = self.start_server(queue_timeouts=[(b'slow', 3)])
+        self.server._command_routing(b'ADD 1 1 x')
+        self.server._command_routing(b'ADD slow 1 y')
+        self.server._command_routing(b'GET 1')
+        self.server._command_routing(b'GET slow')
+        time.sleep(1.1)
+        self.assertEqual(b'0 1 x', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'NONE', self.server._command_routing(b'GET slow'))
+        self.assertEqual((b'slow', 3.5), parse_queue_timeout('slow=3.5'))
+        self.assertRaises(ValueError, parse_queue_timeout, 'slow')
+
+
+    def test_stats(self):
+        task_ids = [self.server._command_routing(b'ADD 1 1 x') for _ in range(3)]
+        self.server._command_routing(b'ADD 2 1 y')
+        self.server._command_routing(b'MGET 1 2')
+        self.server._command_routing(b'ACK 1 ' + task_ids[0])
+        self.assertEqual(b'depth 1 in_flight 1 delayed 0 added 3 got 2 acked 1 expired 0 dead 0', self.server._command_routing(b'STATS 1'))
+        self.assertEqual(b'depth 0 in_flight 0 delayed 0 added 0 got 0 acked 0 expired 0 dead 0', self.server._command_routing(b'STATS 3'))
+        time.sleep(1.1)
+        self.server._expire_tasks()
+        stats = self.server._command_routing(b'STATS').split(b' ')
+        self.assertEqual([b'depth', b'3', b'in_flight', b'0', b'delayed', b'0', b'added', b'4', b'got', b'2', b'acked', b'1',
+                          b'expired', b'1', b'dead', b'0'], stats[:16])
+        self.assertEqual(b'queues', stats[16])
+
+        metrics = self.server._command_routing(b'METRICS').decode('utf-8').split('\n')
+        self.assertIn('task_queue_depth{queue="1"} 2', metrics)
+        self.assertIn('task_queue_tasks_total{queue="1",event="expired"} 1', metrics)
+        self.assertIn('task_queue_command_seconds_count{command="ADD"} 4', metrics)
+        self.assertIn('task_queue_command_seconds_bucket{command="ADD",le="+Inf"} 4', metrics)
+
+
+    def test_metrics_endpoint(self):
+        async def scraping():
+            endpoint = await serve_metrics('127.0.0.1', 0, self.server._scraping)
+            reader, writer = await asyncio.open_connection(*endpoint.sockets[0].getsockname())
+            writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            response = await reader.read()
+            endpoint.close()
+            return response
+
+        self.server._command_routing(b'ADD a"b 1 x')
+        headers, body = asyncio.run(scraping()).split(b'\r\n\r\n', 1)
+        self.assertTrue(headers.startswith(b'HTTP/1.0 200 OK'))
+        self.assertIn(b'task_queue_depth{queue="a\\"b"} 1\n', body)
+
+
+    def test_mmap_storage(self):
+        self.stop_server(self.server)
+        self.server = self.start_server(mmap_storage=True)
+        self.server._storage = PayloadStorage(server_path(self), segment_size=16)
+        task_ids = [self.server._command_routing(f'ADD 1 9 {i} 3 5 7 9'.encode('utf-8')) for i in range(4)]
+        self.server._persisting()
+        self.assertEqual(4, self.payload_segments())
+
+        self.assertEqual(task_ids[0] + b' 9 0 3 5 7 9', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'YES', self.server._command_routing(b'ACK 1 ' + task_ids[0]))
+        # Файл сегмента удаляется только после сброса записи ACK в журнал.
+        self.assertEqual(4, self.payload_segments())
+        self.server._persisting()
+        self.assertEqual(3, self.payload_segments())
+        self.stop_server(self.server)
+
+        self.server = self.start_server()
+        self.assertEqual(task_ids[1] + b' 9 1 3 5 7 9', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'4', self.server._command_routing(b'ADD 1 1 x'))
+        self.assertEqual(task_ids[2] + b' 9 2 3 5 7 9', self.server._command_routing(b'GET 1'))
+
+
+    def test_missing_payload_segment(self):
+        self.stop_server(self.server)
+        self.server = self.start_server(mmap_storage=True)
+        self.server._command_routing(b'ADD 1 1 x')
+        self.server._persisting()
+        self.stop_server(self.server)
+        for name in os.listdir(server_path(self)):
+            if name.startswith('_payloads.'):
+                os.remove(server_path(self) + name)
+
+        # Задание без файла сегмента - ошибка загрузки, а не падение первого GET.
+        self.server = self.start_server(mmap_storage=True)
+        self.assertEqual(b'NONE', self.server._command_routing(b'GET 1'))
+        self.assertEqual(b'0', self.server._command_routing(b'ADD 2 1 y'))
+        self.assertEqual(b'0 1 y', self.server._command_routing(b'GET 2'))
+
+
 if __name__ == '__main__':
     unittest.main()
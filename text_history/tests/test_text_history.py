@@ -1,11 +1,13 @@
 import unittest
 
+import random
+import tracemalloc
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
-from text_history import TextHistory, InsertAction, ReplaceAction, DeleteAction
+from text_history import TextHistory, Action, InsertAction, ReplaceAction, DeleteAction, Rope
 
 class TextHistoryTestCase(unittest.TestCase):
     def test_text__trivial(self):
@@ -37,6 +39,19 @@ class TextHistoryTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             h.action(action)
 
+    def test_action__out_of_range(self):
+        h = TextHistory('a')
+        with self.assertRaises(ValueError):
+            h.action(InsertAction(pos=0, text='x', from_version=0, to_version=2 ** 63))
+        with self.assertRaises(ValueError):
+            h.action(DeleteAction(pos=0, length=2 ** 63, from_version=0, to_version=1))
+
+        # Отклоненное действие не меняет ни текст, ни историю.
+        self.assertEqual(('a', 0), (h.text, h.version))
+        self.assertEqual(1, h.insert('b'))
+        self.assertEqual('ab', h.text)
+        self.assertEqual([(1, 'b')], [(action.pos, action.text) for action in h.get_actions()])
+
     def test_insert(self):
         h = TextHistory()
 
@@ -169,6 +184,91 @@ class TextHistoryTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             h.get_actions(-1, 1)
 
+    def test_text_at(self):
+        rng = random.Random(3)
+        h = TextHistory('start', checkpoint_interval=7, checkpoint_size=20)
+        texts = [h.text]
+        for _ in range(200):
+            pos = rng.randint(0, len(h.text))
+            rng.choice((lambda: h.insert('ab' * rng.randint(0, 10), pos),
+                        lambda: h.replace('XYZ', pos),
+                        lambda: h.delete(pos, min(2, len(h.text) - pos))))()
+            texts.append(h.text)
+        for version in rng.sample(range(len(texts)), 50) + [0, 200]:
+            self.assertEqual(texts[version], h.text_at(version))
+
+    def test_text_at__checkpoint_memory(self):
+        h = TextHistory('x' * 2 ** 20)
+        rng = random.Random(5)
+        positions = [rng.randint(0, length) for length in range(2 ** 20, 2 ** 20 + 2000)]
+        tracemalloc.start()
+        for pos in positions:
+            h.insert('y', pos)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # Снимки каждые 100 действий делят куски с текстом: 20 копий текста заняли бы 20 МБ.
+        self.assertLess(memory, 8 * 2 ** 20)
+        text = 'x' * 2 ** 20
+        for pos in positions[:150]:
+            text = f'{text[:pos]}y{text[pos:]}'
+        self.assertEqual(text, h.text_at(150))
+        self.assertEqual('x' * 2 ** 20, h.text_at(0))
+        self.assertEqual(2 ** 20 + 1000, len(h.text_at(1000)))
+
+    def test_text_at__skipped_versions(self):
+        h = TextHistory('a')
+        h.action(InsertAction(pos=1, text='b', from_version=0, to_version=5))
+        h.insert('c')
+
+        self.assertEqual('a', h.text_at(4))
+        self.assertEqual('ab', h.text_at(5))
+        self.assertEqual('abc', h.text_at(6))
+        with self.assertRaises(ValueError):
+            h.text_at(7)
+        with self.assertRaises(ValueError):
+            h.text_at(-1)
+
+    def test_iter_actions(self):
+        h = TextHistory()
+        for char in 'abcdef':
+            h.insert(char)
+
+        actions = h.iter_actions(2, 5)
+        self.assertNotIsInstance(actions, list)
+        self.assertEqual(['c', 'd', 'e'], [action.text for action in actions])
+        self.assertEqual([action.text for action in h.get_actions()], [action.text for action in h.iter_actions()])
+        self.assertEqual([], list(h.iter_actions(6)))
+        with self.assertRaises(ValueError):
+            h.iter_actions(2, 7)
+
+    def test_action_log(self):
+        h = TextHistory()
+        h.insert('абв')
+        h.replace('\ud800x', pos=1)
+        h.delete(pos=0, length=2)
+        h.action(Action(pos=None, from_version=3, to_version=5))
+
+        insert, replace, delete, action = h.get_actions()
+        self.assertEqual((InsertAction, 0, 'абв', 0, 1), (type(insert), insert.pos, insert.text, insert.from_version, insert.to_version))
+        self.assertEqual((ReplaceAction, 1, '\ud800x', 1, 2), (type(replace), replace.pos, replace.text, replace.from_version, replace.to_version))
+        self.assertEqual((DeleteAction, 0, 2, 2, 3), (type(delete), delete.pos, delete.length, delete.from_version, delete.to_version))
+        self.assertEqual((Action, 1, 3, 5), (type(action), action.pos, action.from_version, action.to_version))
+        with self.assertRaises(AttributeError):
+            insert.extra = 1
+
+    def test_get_actions__skipped_versions(self):
+        h = TextHistory()
+        h.insert('a')
+        h.action(InsertAction(pos=1, text='b', from_version=1, to_version=10))
+        h.insert('c')
+
+        self.assertEqual(['b', 'c'], [action.text for action in h.get_actions(1)])
+        self.assertEqual(['a'], [action.text for action in h.get_actions(0, 9)])
+        self.assertEqual(['c'], [action.text for action in h.get_actions(10, 11)])
+        with self.assertRaises(ValueError):
+            h.get_actions(5)
+
     def test_get_actions__empty(self):
         h = TextHistory()
         self.assertEqual([], h.get_actions())
@@ -200,12 +300,107 @@ class TextHistoryTestOptimization(unittest.TestCase):
         h.replace('67', 1)
 
         actions = h.get_actions(optimization=True)
-        self.assertEqual(9, len(actions))
+        self.assertEqual(1, len(actions))
         self.assertEqual('1675', h.text)
+        self.assertIsInstance(actions[0], InsertAction)
+        self.assertEqual(('1675', 0, 0, 16), (actions[0].text, actions[0].pos, actions[0].from_version, actions[0].to_version))
+
+        actions = h.get_actions(4, 12, optimization=True)
+        self.assertEqual(1, len(actions))
+        self.assertIsInstance(actions[0], ReplaceAction)
+        self.assertEqual(('STARTxxxyyzEND!!!', 0, 4, 12), (actions[0].text, actions[0].pos, actions[0].from_version, actions[0].to_version))
+        self.assertEqual(h.text_at(12), actions[0].apply(h.text_at(4)))
+
+    def test_optimization__separate_edits(self):
+        h = TextHistory('0123456789')
+        h.insert('a', 0)
+        h.insert('b', 6)
+        h.insert('c', 7)
+        h.delete(0, 1)
+        h.delete(4, 3)
+        h.insert('d', 4)
 
-        versions = iter(((0, 3), (3, 4), (4, 6), (6, 7), (7, 10), (10, 11), (11, 12), (12, 13), (13, 16)))
-        for action in actions:
-            self.assertEqual(next(versions), (action.from_version, action.to_version))
+        actions = h.get_actions(optimization=True)
+        self.assertEqual([(InsertAction, 0, 'a', 0, 1), (InsertAction, 6, 'bc', 1, 3), (DeleteAction, 0, 1, 3, 4)],
+                         [(type(action), action.pos, getattr(action, 'text', getattr(action, 'length', None)), action.from_version, action.to_version)
+                          for action in actions[:3]])
+        # Удаление другой длины рядом со вставкой одним действием не выражается.
+        self.assertEqual([(DeleteAction, 4, 3, 4, 5), (InsertAction, 4, 'd', 5, 6)],
+                         [(type(action), action.pos, getattr(action, 'text', getattr(action, 'length', None)), action.from_version, action.to_version)
+                          for action in actions[3:]])
+        self.assertEqual('0123d56789', h.text)
+
+    def test_optimization__replay(self):
+        rng = random.Random(11)
+        for _ in range(200):
+            h = TextHistory(''.join(rng.choice('ab') for _ in range(rng.randint(0, 8))))
+            for _ in range(rng.randint(1, 30)):
+                pos = rng.randint(0, len(h.text))
+                rng.choice((lambda: h.insert(rng.choice(('x', 'yz', '')), pos),
+                            lambda: h.replace(rng.choice(('Q', 'RS', 'TUV')), pos),
+                            lambda: h.delete(pos, rng.randint(0, len(h.text) - pos))))()
+
+            from_version = rng.randint(0, h.version)
+            to_version = rng.randint(from_version, h.version)
+            actions = h.get_actions(from_version, to_version, optimization=True)
+            self.assertLessEqual(len(actions), to_version - from_version)
+            text = h.text_at(from_version)
+            for previous, action in zip([None] + actions, actions):
+                self.assertEqual(previous.to_version if previous else from_version, action.from_version)
+                text = action.apply(text)
+                # Каждое свернутое действие заканчивается настоящей версией истории.
+                self.assertEqual(h.text_at(action.to_version), text)
+            self.assertEqual(h.text_at(to_version), text)
+
+    def test_optimization__long_range(self):
+        h = TextHistory('start')
+        for _ in range(50000):
+            h.insert('x')
+        for _ in range(10000):
+            h.delete(len(h.text) - 1)
+
+        actions = h.get_actions(1, optimization=True)
+        self.assertEqual(1, len(actions))
+        self.assertEqual(('x' * 39999, 6), (actions[0].text, actions[0].pos))
+
+
+class RopeTestCase(unittest.TestCase):
+    def test_random_edits(self):
+        rng = random.Random(42)
+        text = ''.join(rng.choice('abc\n') for _ in range(5000))
+        rope = Rope(text)
+        for _ in range(3000):
+            pos = rng.randint(0, len(text))
+            length = rng.randint(0, min(len(text) - pos, rng.choice((3, 3000))))
+            new_text = ''.join(rng.choice('xyz') for _ in range(rng.choice((0, 1, 5, 2000))))
+            rope.replace(pos, length, new_text)
+            text = f'{text[:pos]}{new_text}{text[pos + length:]}'
+            self.assertEqual(len(text), len(rope))
+        self.assertEqual(text, str(rope))
+
+    def test_copy(self):
+        rope = Rope('abc' * 1000)
+        copy = rope.copy()
+        rope.replace(10, 5, 'xyz')
+        copy.replace(0, 0, 'start')
+        copy_of_copy = copy.copy()
+        copy.replace(2000, 1000, '')
+        self.assertEqual(('abc' * 1000)[:10] + 'xyz' + ('abc' * 1000)[15:], str(rope))
+        self.assertEqual('start' + 'abc' * 1000, str(copy_of_copy))
+        self.assertEqual(('start' + 'abc' * 1000)[:2000] + ('start' + 'abc' * 1000)[3000:], str(copy))
+
+    def test_history_matches_apply(self):
+        rng = random.Random(7)
+        h = TextHistory('0123456789' * 300)
+        text = h.text
+        for _ in range(500):
+            pos = rng.randint(0, len(text))
+            action = rng.choice((InsertAction(pos, 'ab', h.version, h.version + 1),
+                                 ReplaceAction(pos, 'XYZ', h.version, h.version + 1),
+                                 DeleteAction(pos, min(4, len(text) - pos), h.version, h.version + 1)))
+            h.action(action)
+            text = action.apply(text)
+        self.assertEqual(text, h.text)
 
 
 if __name__ == '__main__':
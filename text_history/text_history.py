@@ -1,50 +1,98 @@
 from collections.abc import Iterator
+from typing import NamedTuple
+from operator import itemgetter
+from array import array
+import bisect
+import random
 
 
 class Action:
+    __slots__ = ('pos', 'from_version', 'to_version')
+    id = None
+
     def __init__(self, pos: int, from_version: int, to_version: int):
         self.pos = pos
         self.from_version = from_version
         self.to_version = to_version
-        self.id = None
 
 
-    def apply(self, string: str) -> str:
+    def _check_position(self, length: int) -> None:
         if self.pos is None:
-            self.pos = len(string)
-        if self.pos > len(string) or self.pos < 0:
+            self.pos = length
+        if self.pos > length or self.pos < 0:
             raise ValueError
 
+
+    def apply(self, string: str) -> str:
+        self._check_position(len(string))
         return string
 
 
+    def edit(self, rope: 'Rope') -> None:
+        '''Применяет действие к тексту, хранящемуся в rope, без копирования всего текста.'''
+        self._check_position(len(rope))
+
+
+    @property
+    def size(self) -> int:
+        '''Сколько символов текста затрагивает действие.'''
+        return 0
+
+
 class InsertAction(Action):
+    __slots__ = ('text',)
+    id = 'I'
+
     def __init__(self, pos: int, text: str, from_version: int, to_version: int):
         super().__init__(pos, from_version, to_version)
         self.text = text
-        self.id = 'I'
 
 
     def apply(self, string: str) -> str:
         return f'{super().apply(string)[:self.pos]}{self.text}{string[self.pos:]}'
 
 
+    def edit(self, rope: 'Rope') -> None:
+        super().edit(rope)
+        rope.replace(self.pos, 0, self.text)
+
+
+    @property
+    def size(self) -> int:
+        return len(self.text)
+
+
 class ReplaceAction(Action):
+    __slots__ = ('text',)
+    id = 'R'
+
     def __init__(self, pos: int, text: str, from_version: int, to_version: int):
         super().__init__(pos, from_version, to_version)
         self.text = text
-        self.id = 'R'
 
 
     def apply(self, string: str) -> str:
         return f'{super().apply(string)[:self.pos]}{self.text}{string[self.pos + len(self.text):]}'
 
 
+    def edit(self, rope: 'Rope') -> None:
+        super().edit(rope)
+        # Замена за концом текста дописывает текст.
+        rope.replace(self.pos, min(len(self.text), len(rope) - self.pos), self.text)
+
+
+    @property
+    def size(self) -> int:
+        return len(self.text)
+
+
 class DeleteAction(Action):
+    __slots__ = ('length',)
+    id = 'D'
+
     def __init__(self, pos: int, length: int, from_version: int, to_version: int):
         super().__init__(pos, from_version, to_version)
         self.length = length
-        self.id = 'D'
 
 
     def apply(self, string: str) -> str:
@@ -53,15 +101,347 @@ class DeleteAction(Action):
         return f'{super().apply(string)[:self.pos]}{string[self.pos + self.length:]}'
 
 
-class TextHistory:
+    def edit(self, rope: 'Rope') -> None:
+        if (self.pos + self.length) > len(rope) or self.length < 0:
+            raise ValueError
+        super().edit(rope)
+        rope.replace(self.pos, self.length, '')
+
+
+    @property
+    def size(self) -> int:
+        return self.length
+
+
+class Splice(NamedTuple):
+    '''Действие как замена отрезка: с позиции pos убирается removed символов и вставляется text.
+       text_length - длина текста до действия, first и last - номера первого и последнего свернутых в него действий.'''
+    pos: int
+    removed: int
+    text: 'str | Rope'
+    text_length: int
+    first: int
+    last: int
+
+
+class ActionLog:
+    '''Колонночное хранилище действий: вид, позиция, длина и версии лежат в параллельных массивах array,
+       тексты вставок и замен - подряд в одном буфере UTF-8 со смещениями. Объекты Action создаются только при чтении.
+       Действия неизвестных видов хранятся как Action.'''
+    KINDS = {None: 0, 'I': 1, 'R': 2, 'D': 3}
+
+    def __init__(self, text_length: int=0):
+        self._kinds = array('B')
+        self._positions = array('q')
+        self._lengths = array('q') # Длина удаления или длина текста вставки и замены в символах.
+        self.versions = array('q', [0]) # i-е действие переводит текст из версии versions[i] в versions[i + 1].
+        self._offsets = array('q', [0]) # Текст i-го действия - байты _texts[_offsets[i]:_offsets[i + 1]].
+        self._texts = bytearray()
+        self._text_lengths = array('q', [text_length]) # Длина текста в версии versions[i].
+
+
+    def __len__(self) -> int:
+        return len(self._kinds)
+
+
+    def check(self, action: Action) -> None:
+        '''Проверяет, что числа действия помещаются в колонки, до того как действие изменит текст.
+           Позиция None заменяется длиной текста, поэтому всегда помещается.'''
+        try:
+            array('q', (action.pos or 0, action.size, action.to_version))
+        except OverflowError:
+            raise ValueError
+
+
+    def append(self, action: Action, text_length: int) -> None:
+        '''Добавляет примененное действие, text_length - длина текста после него.
+           Строка собирается целиком до изменения колонок, поэтому ошибка не оставляет их разной длины.'''
+        kind = self.KINDS.get(action.id, 0)
+        pos, length, to_version, text_length = array('q', (action.pos, action.size, action.to_version, text_length))
+        # surrogatepass сохраняет и одиночные суррогаты, которые допустимы в str.
+        text = action.text.encode('utf-8', 'surrogatepass') if kind in (1, 2) else b''
+        self._kinds.append(kind)
+        self._positions.append(pos)
+        self._lengths.append(length)
+        self.versions.append(to_version)
+        self._texts += text
+        self._offsets.append(len(self._texts))
+        self._text_lengths.append(text_length)
+
+
+    def __getitem__(self, index: int) -> Action:
+        kind = self._kinds[index]
+        pos, from_version, to_version = self._positions[index], self.versions[index], self.versions[index + 1]
+        if kind == 3:
+            return DeleteAction(pos, self._lengths[index], from_version, to_version)
+        if kind == 0:
+            return Action(pos, from_version, to_version)
+        return (InsertAction if kind == 1 else ReplaceAction)(pos, self._text(index), from_version, to_version)
+
+
+    def _text(self, index: int) -> str:
+        return self._texts[self._offsets[index]:self._offsets[index + 1]].decode('utf-8', 'surrogatepass')
+
+
+    def compact(self, actions: range) -> list[Action]:
+        '''Сворачивает действия диапазона за один проход: каждое следующее действие склеивается с предыдущим результатом,
+           если их отрезки пересекаются или соприкасаются и вместе они выражаются одним действием, после чего
+           результат пробует склеиться с тем, что перед ним. Каждое склеивание уменьшает число действий, поэтому проход
+           линейный, а тексты больших склеек правятся в Rope за O(log n). Действия не переставляются, поэтому каждое
+           свернутое действие по-прежнему заканчивается настоящей версией истории.'''
+        splices = []
+        for index in actions:
+            splice = self._splice(index)
+            while splices and (merged := self._merge(splices[-1], splice)):
+                splice = merged
+                splices.pop()
+            splices.append(splice)
+        return [self._splice_action(splice) for splice in splices]
+
+
+    def _splice(self, index: int) -> Splice:
+        kind, pos, length, text_length = self._kinds[index], self._positions[index], self._lengths[index], self._text_lengths[index]
+        if kind == 3:
+            return Splice(pos, length, '', text_length, index, index)
+        if kind == 0:
+            return Splice(pos, 0, '', text_length, index, index)
+        removed = 0 if kind == 1 else min(length, text_length - pos)
+        return Splice(pos, removed, self._text(index), text_length, index, index)
+
+
+    @staticmethod
+    def _merge(first: Splice, second: Splice) -> Splice | None:
+        '''Склеивает две последовательные замены в одну, None - если отрезки не соприкасаются или склейка
+           не выражается одним действием (например, вставка и удаление разной длины рядом с ней).'''
+        inserted = len(first.text)
+        if second.pos > first.pos + inserted or second.pos + second.removed < first.pos:
+            return None
+
+        # Все символы исходного текста в объединенном отрезке, не вошедшие в first, удаляет second,
+        # поэтому новый текст собирается из second.text и уцелевших краев first.text.
+        pos = min(first.pos, second.pos)
+        removed = first.pos + first.removed + max(0, second.pos + second.removed - first.pos - inserted) - pos
+        start = min(max(second.pos - first.pos, 0), inserted)
+        end = min(second.pos + second.removed - first.pos, inserted)
+        length = inserted - (end - start) + len(second.text)
+        if removed and length and removed != min(length, first.text_length - pos):
+            return None
+
+        text = first.text
+        if isinstance(text, str) and length <= Rope.CHUNK_SIZE:
+            text = f'{text[:start]}{second.text}{text[end:]}'
+        else:
+            text = Rope(text) if isinstance(text, str) else text
+            text.replace(start, end - start, str(second.text))
+        return Splice(pos, removed, text, first.text_length, first.first, second.last)
+
+
+    def _splice_action(self, splice: Splice) -> Action:
+        from_version, to_version = self.versions[splice.first], self.versions[splice.last + 1]
+        if splice.first == splice.last:
+            return self[splice.first]
+        if not splice.text:
+            return DeleteAction(splice.pos, splice.removed, from_version, to_version)
+        if not splice.removed:
+            return InsertAction(splice.pos, str(splice.text), from_version, to_version)
+        return ReplaceAction(splice.pos, str(splice.text), from_version, to_version)
+
+
+class RopeNode:
+    '''Узел декартова дерева Rope: кусок текста, случайный приоритет и длина текста всего поддерева.
+       owner - Rope, который может менять узел на месте, узлы других Rope перед изменением копируются.'''
+    __slots__ = ('chunk', 'priority', 'left', 'right', 'size', 'owner')
+
+    def __init__(self, chunk: str, priority: float=None, owner: object=None):
+        self.chunk = chunk
+        self.priority = random.random() if priority is None else priority
+        self.left = None
+        self.right = None
+        self.size = len(chunk)
+        self.owner = owner
+
+
+    def update(self) -> None:
+        self.size = len(self.chunk) + (self.left.size if self.left else 0) + (self.right.size if self.right else 0)
+
+
+class Rope:
+    '''Текст, разбитый на куски не длиннее CHUNK_SIZE, которые хранятся в декартовом дереве по неявному ключу (позиции).
+       Правка внутри одного куска меняет только его и длины узлов на пути к нему, остальные правки
+       разрезают и склеивают дерево. И то и другое - O(log n) при ожидаемой глубине дерева, текст целиком не копируется.
+       copy делит узлы между копиями, изменяемый узел копируется, поэтому копии не видят правок друг друга.'''
+    CHUNK_SIZE = 1024
+
     def __init__(self, text: str=''):
-        self._text = text
+        self._owner = object() # Метка узлов, которые принадлежат только этому Rope.
+        self._root = self._build(text)
+
+
+    def copy(self) -> 'Rope':
+        '''Возвращает копию за O(1). Обе копии получают новые метки, поэтому общие узлы больше не меняются на месте,
+           а каждая правка копирует только узлы на своем пути: O(log n) узлов и один кусок.'''
+        rope = Rope()
+        rope._root = self._root
+        self._owner = object()
+        return rope
+
+
+    def _own(self, node: RopeNode) -> RopeNode:
+        '''Возвращает узел, который можно менять на месте: сам узел или его копию, если узел общий с другой копией.'''
+        if node.owner is self._owner:
+            return node
+        copy = RopeNode(node.chunk, node.priority, self._owner)
+        copy.left = node.left
+        copy.right = node.right
+        copy.size = node.size
+        return copy
+
+
+    def __len__(self) -> int:
+        return self._root.size if self._root else 0
+
+
+    def __str__(self) -> str:
+        chunks = []
+        stack = []
+        node = self._root
+        while stack or node:
+            while node:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            chunks.append(node.chunk)
+            node = node.right
+        return ''.join(chunks)
+
+
+    def replace(self, pos: int, length: int, text: str) -> None:
+        '''Заменяет length символов с позиции pos на text. Позиции должны быть проверены вызывающим кодом.'''
+        if (length or text) and not self._edit_chunk(pos, length, text):
+            left, rest = self._split(self._root, pos)
+            _, right = self._split(rest, length)
+            self._root = self._merge(self._merge(left, self._build(text)), right)
+
+
+    def _edit_chunk(self, pos: int, length: int, text: str) -> bool:
+        '''Правит кусок на месте, если заменяемый отрезок лежит внутри одного куска и кусок не станет длиннее CHUNK_SIZE или пустым.'''
+        path = []
+        node = self._root
+        while node:
+            path.append(node)
+            left_size = node.left.size if node.left else 0
+            if pos < left_size:
+                node = node.left
+                continue
+            pos -= left_size
+            if pos + length <= len(node.chunk):
+                break
+            if pos < len(node.chunk):
+                return False
+            pos -= len(node.chunk)
+            node = node.right
+
+        if not node or not 0 < len(node.chunk) - length + len(text) <= self.CHUNK_SIZE:
+            return False
+        parent = None
+        for node in path:
+            owned = self._own(node)
+            if parent is None:
+                self._root = owned
+            elif parent.left is node:
+                parent.left = owned
+            else:
+                parent.right = owned
+            owned.size += len(text) - length
+            parent = owned
+        parent.chunk = f'{parent.chunk[:pos]}{text}{parent.chunk[pos + length:]}'
+        return True
+
+
+    def _build(self, text: str) -> RopeNode | None:
+        '''Строит из кусков текста сбалансированное дерево за линейное время, затем раздает узлам случайные приоритеты
+           по убыванию в порядке обхода в ширину, чтобы приоритет родителя был не меньше приоритетов детей.'''
+        nodes = [RopeNode(text[start:start + self.CHUNK_SIZE], owner=self._owner) for start in range(0, len(text), self.CHUNK_SIZE)]
+
+        def link(start: int, end: int) -> RopeNode | None:
+            if start >= end:
+                return None
+            middle = (start + end) // 2
+            node = nodes[middle]
+            node.left = link(start, middle)
+            node.right = link(middle + 1, end)
+            node.update()
+            return node
+
+        root = link(0, len(nodes))
+        level = [root] if root else []
+        priorities = iter(sorted((node.priority for node in nodes), reverse=True))
+        while level:
+            for node in level:
+                node.priority = next(priorities)
+            level = [child for node in level for child in (node.left, node.right) if child]
+        return root
+
+
+    def _split(self, node: RopeNode | None, pos: int) -> tuple[RopeNode | None, RopeNode | None]:
+        '''Разрезает дерево на первые pos символов и остальные, кусок на границе делится на два узла.'''
+        if not node:
+            return None, None
+        node = self._own(node)
+        left_size = node.left.size if node.left else 0
+        if pos <= left_size:
+            left, node.left = self._split(node.left, pos)
+            node.update()
+            return left, node
+        pos -= left_size
+        if pos >= len(node.chunk):
+            node.right, right = self._split(node.right, pos - len(node.chunk))
+            node.update()
+            return node, right
+
+        # Приоритет правой половины равен приоритету узла, поэтому ее можно подвесить над его правым поддеревом.
+        right = RopeNode(node.chunk[pos:], node.priority, self._owner)
+        right.right = node.right
+        right.update()
+        node.chunk = node.chunk[:pos]
+        node.right = None
+        node.update()
+        return node, right
+
+
+    def _merge(self, left: RopeNode | None, right: RopeNode | None) -> RopeNode | None:
+        if not left or not right:
+            return left or right
+        if left.priority > right.priority:
+            left = self._own(left)
+            left.right = self._merge(left.right, right)
+            left.update()
+            return left
+        right = self._own(right)
+        right.left = self._merge(left, right.left)
+        right.update()
+        return right
+
+
+class TextHistory:
+    def __init__(self, text: str='', checkpoint_interval: int=100, checkpoint_size: int=2**16):
+        self._rope = Rope(text)
+        self._text = text # Текст собирается из Rope только при обращении к text, None - еще не собран.
         self._version = 0
-        self._actions = {}
+        self._actions = ActionLog(len(text))
+        # Снимки текста (версия, число действий до нее, копия Rope), от ближайшего снимка text_at повторяет действия.
+        # Копии делят с текущим Rope неизмененные куски, поэтому снимок хранит только куски, измененные после него.
+        self._checkpoints = [(0, 0, self._rope.copy())]
+        self._checkpoint_interval = checkpoint_interval # Через сколько действий делается снимок.
+        self._checkpoint_size = checkpoint_size # Через сколько измененных символов делается снимок.
+        self._unsaved_actions = 0
+        self._unsaved_size = 0
 
 
     @property
     def text(self):
+        if self._text is None:
+            self._text = str(self._rope)
         return self._text
 
 
@@ -71,134 +451,20 @@ class TextHistory:
 
 
     def __action(self, action: Action) -> int:
-        self._text = action.apply(self._text)
-        self._actions[self._version] = action
-        self._version += 1
-
-
-    def __optimization(self, actions: Iterator[Action]) -> list[Action]:
-        '''Принимает на вход итератор состоящий из действий которые были совершены в период указанных версии,
-           если несколько действии можно объеденить в одно - объединяет, возвращает оптимизированный список действии.'''
-
-        def insert_actions(actions: Iterator[Action]) -> list[Action]:
-            # text = ''
-            # insert('q', pos=0), insert('w', pos=1), insert('erty', pos=2) -> insert('qwerty', pos=0)
-            result_actions = []
-
-            action, next_action = next(actions, None), next(actions, None)
-            while next_action:
-                if action.pos + len(action.text) == next_action.pos:
-                    position = action.pos
-                    from_version = action.from_version
-                    list_text = [action.text, next_action.text]
-
-                    action, next_action = next_action, next(actions, None)
-                    while next_action and action.pos + len(action.text) == next_action.pos:
-                        list_text.append(next_action.text)
-                        action, next_action = next_action, next(actions, None)
-
-                    result_actions.append(InsertAction(position, ''.join(list_text), from_version, action.to_version))
-                    action, next_action = next_action, next(actions, None)
-                    list_text.clear()
-                else:
-                    result_actions.append(action)
-                    action, next_action = next_action, next(actions, None)
-
-            last_action = action or next_action
-            if last_action:
-                result_actions.append(last_action)
-
-            return result_actions
-
-
-        def replace_actions(actions: Iterator[Action]) -> list[Action]:
-            # text = 'qwerty'
-            # replace('12', 1) > 'q12rty', replace('345', 2) > 'q1345y' -> replace('1345', 1)
-            result_actions = []
-            action, next_action = next(actions, None), next(actions, None)
-            while next_action:
-                if (len(action.text) - next_action.pos >= 0) and (next_action.pos <= action.pos + len(action.text)):
-                    position = action.pos
-                    from_version = action.from_version
-                    list_text = [action.text[:next_action.pos - 1]]
-
-                    action, next_action = next_action, next(actions, None)
-                    while next_action and ((len(action.text) - next_action.pos >= 0) and (next_action.pos <= action.pos + len(action.text))):
-                        list_text.append(action.text[:next_action.pos])
-                        action, next_action = next_action, next(actions, None)
-
-                    result_actions.append(ReplaceAction(position, ''.join(list_text), from_version, action.to_version))
-                    action, next_action = next_action, next(actions, None)
-                    list_text.clear()
-                else:
-                    result_actions.append(action)
-                    action, next_action = next_action, next(actions, None)
-
-            last_action = action or next_action
-            if last_action:
-                result_actions.append(last_action)
-
-            return result_actions
-
-
-        def delete_actions(actions: Iterator[Action]) -> list[Action]:
-            # text = 'qwerty'
-            # delete(0, 1), delete(0, 1), delete(0, 1) -> delete(0, 3)
-            result_actions = []
-
-            action, next_action = next(actions, None), next(actions, None)
-
-            while next_action:
-                if next_action.pos == action.pos:
-                    position = action.pos
-                    from_version = action.from_version
-                    length = action.length + next_action.length
-                    action, next_action = next_action, next(actions, None)
-
-                    while next_action and next_action.pos == action.pos:
-                        length += next_action.length
-                        action, next_action = next_action, next(actions, None)
-
-                    result_actions.append(DeleteAction(position, length, from_version, action.to_version))
-                    action, next_action = next_action, next(actions, None)
-                    length = 0
-                else:
-                    result_actions.extend([action, next_action])
-                    action, next_action = next(actions, None), next(actions, None)
-
-            last_action = action or next_action
-            if last_action:
-                result_actions.append(last_action)
-
-            return result_actions
-
-        funcs = {'I': insert_actions, 'R': replace_actions, 'D': delete_actions}
-
-        result_actions = []
-        action, next_action = next(actions, None), next(actions, None)
-
-        while action and next_action:
-            temp_actions = []
-            if action.id == next_action.id:
-                while next_action and action.id == next_action.id:
-                    temp_actions.append(action)
-                    action, next_action = next_action, next(actions, None)
-                temp_actions.append(action)
-
-                id = action.id
-                action, next_action = next_action, next(actions, None)
-
-                result_actions.extend(funcs[id](iter(temp_actions[:])))
-                temp_actions.clear()
-            else:
-                result_actions.append(action)
-                action, next_action = next_action, next(actions, None)
+        self._actions.check(action)
+        action.edit(self._rope)
+        self._text = None
+        self._actions.append(action, len(self._rope))
+        self._version = action.to_version
+        self.__checkpoint(action)
 
-        action = action or next_action
-        if action:
-            result_actions.append(action)
 
-        return result_actions
+    def __checkpoint(self, action: Action) -> None:
+        self._unsaved_actions += 1
+        self._unsaved_size += action.size
+        if self._unsaved_actions >= self._checkpoint_interval or self._unsaved_size >= self._checkpoint_size:
+            self._checkpoints.append((self._version, len(self._actions), self._rope.copy()))
+            self._unsaved_actions = self._unsaved_size = 0
 
 
     def insert(self, text: str, pos: int=None) -> int:
@@ -221,19 +487,49 @@ class TextHistory:
             raise ValueError
         else:
             self.__action(action)
-            self._version = action.to_version
             return self._version
 
 
-    def get_actions(self, from_version: int=None, to_version: int=None, optimization: bool=False) -> list[Action]:
+    def text_at(self, version: int) -> str:
+        '''Возвращает текст версии version: результат всех действий, которые привели к версии не больше нее.
+           Действия повторяются от ближайшего снимка до этой версии, а не от начала истории.'''
+        if not 0 <= version <= self._version:
+            raise ValueError
+        if version == self._version:
+            return self.text
+
+        checkpoint = bisect.bisect_right(self._checkpoints, version, key=itemgetter(0)) - 1
+        _, action_count, rope = self._checkpoints[checkpoint]
+        actions = range(action_count, bisect.bisect_right(self._actions.versions, version) - 1)
+        if not actions:
+            return str(rope)
 
+        rope = rope.copy()
+        for index in actions:
+            self._actions[index].edit(rope)
+        return str(rope)
+
+
+    def __action_range(self, from_version: int=None, to_version: int=None) -> range:
+        '''Возвращает номера действий между версиями, from_version должна быть одной из версий истории.
+           Версии действий возрастают, поэтому границы ищутся двоичным поиском, без обхода истории.'''
         to_version = self._version if to_version is None else to_version
         from_version = 0 if from_version is None else from_version
+        versions = self._actions.versions
 
-        if ((from_version not in self._actions) and self._actions) or to_version > self._version or from_version > to_version:
+        start = bisect.bisect_left(versions, from_version)
+        if start == len(versions) or versions[start] != from_version or to_version > self._version or from_version > to_version:
             raise ValueError
+        return range(start, bisect.bisect_right(versions, to_version) - 1)
+
 
+    def iter_actions(self, from_version: int=None, to_version: int=None) -> Iterator[Action]:
+        '''Как get_actions, но возвращает ленивый итератор: стоимость зависит только от числа выданных действий.'''
+        return map(self._actions.__getitem__, self.__action_range(from_version, to_version))
+
+
+    def get_actions(self, from_version: int=None, to_version: int=None, optimization: bool=False) -> list[Action]:
         if optimization:
-            return self.__optimization(iter([self._actions[version] for version in tuple(self._actions)[from_version:to_version]]))
+            return self._actions.compact(self.__action_range(from_version, to_version))
 
-        return [self._actions[version] for version in tuple(self._actions)[from_version:to_version]]
+        return list(self.iter_actions(from_version, to_version))